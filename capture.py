@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 import argparse
-from multiprocessing import Process
 import yaml
 import lights
+import libshotlist
+import libpreflight
+from libtiming import SessionTiming, phase
+from libjournal import Journal
+from os import path
+import shutil
+import tempfile
 # from datetime import datetime
 # import numpy as np
 # from os import makedirs, path
@@ -13,70 +19,73 @@ def getArguments():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-c','--configuration')
 	parser.add_argument('-s','--shotlist')
-	parser.add_argument('-t','--target')
+	parser.add_argument('-t','--target',nargs='+') # more than one target runs the shotlist for each on the same camera and lights
+	parser.add_argument('-b','--batch',action='store_true') # after the targets given, ask for the next target until a blank answer
 	parser.add_argument('-v','--verbose',action='store_true')
 	parser.add_argument('-w','--worklights',action='store_true')
+	parser.add_argument('-p','--pipeline',action='store_true') # analyze and save each frame in the background while the next shot begins
+	parser.add_argument('-o','--overlap',action='store_true') # move the wheel while lights switch and settle, see libsession
+	parser.add_argument('--strobe',action='store_true') # turn each light off as soon as the exposure ends instead of after saving
+	parser.add_argument('-a','--autoexposure',action='store_true') # converge on each exposure with binned test frames before the full resolution shot
+	parser.add_argument('--save-shotlist') # with -a, write the converged exposures to this shotlist
+	parser.add_argument('--schedule',action='store_true') # reorder shots to minimize filter wheel travel and light switching
+	parser.add_argument('--calibrate-wheel',action='store_true') # time every filter wheel move so that later sessions wait only as long as each move takes
+	parser.add_argument('--calibrate-settle',action='store_true') # measure how long each light in the shotlist takes to steady and save it for later sessions
+	parser.add_argument('-r','--resume',action='store_true') # skip shots this target's journal shows were already saved intact
+	parser.add_argument('-n','--dry-run',action='store_true') # simulate camera and lights to estimate how long the session would take
+	parser.add_argument('-l','--local',action='store_true') # open the camera here even if capturedaemon.py is running
 	return parser.parse_args()
 
-if __name__ == "__main__":
-	print("Gathering arguments from the command line")
-	args = getArguments()
-	if args.configuration and args.configuration.lower().endswith('.yaml'):
-		with open(args.configuration,'r') as unparsedyaml:
-			config = yaml.load(unparsedyaml,Loader=yaml.SafeLoader)
-	else:
-		print("It is necessary to specify a configuration file")
-		exit()
-	if args.shotlist and args.shotlist.lower().endswith('.yaml'): # makes sense to use yaml for config and txt for shotlist
-		with open (args.shotlist,'r') as unparsedyaml:
-			shotlist = yaml.load(unparsedyaml,Loader=yaml.SafeLoader)
-	elif args.shotlist and args.shotlist.lower().endswith('txt'):
-		with open (args.shotlist,'r') as unparsedtxt:
-			shotlist = unparsedtxt.readlines()
-	else: 
-		print("It is necessary to specify a shotlist file")
-		exit()
-	if not args.target:
-		print("Let's just stop here because you're going to need to specify a target before we can save anything.")
-		exit()
+def initCamera(config,target,clock=None):
 	print("Initializing camera")
-	if config['sensor'].lower().startswith('qhy'):
+	if clock:
+		import libsim
+		camera = libsim.Simulator(clock)
+		camera.session(config,target)
+	elif config['sensor'].lower().startswith('simulat'):
+		import libsim
+		camera = libsim.Simulator()
+		camera.session(config,target)
+	elif config['sensor'].lower().startswith('qhy'):
 		import libqhy 
 		camera = libqhy.Qhyccd()
-		camera.session(config,args.target)
+		camera.session(config,target)
 	elif config['sensor'].lower().startswith('q15'):
 		import libqhy 
 		camera = libqhy.Qhyccd()
-		camera.session(config,args.target)
+		camera.session(config,target)
 	elif config['sensor'].lower().startswith('canon'):
 		from libcanon import Canon 
-		camera = Canon(config,args.target)
+		camera = Canon(config,target)
 	elif config['sensor'].lower().startswith('flir'):
 		from libflir import Flir
 		camera = Flir()
-		camera.session(config,args.target)
+		camera.session(config,target)
 	elif config['sensor'].lower().startswith('kolarielph'):
 		from libchdk import Chdk
 		camera = Chdk()
-		camera.session(config,args.target)
+		camera.session(config,target)
 	elif config['sensor'].lower().startswith('pixelink'):
 		from libpixelink import Pixelink
 		camera = Pixelink()
-		camera.session(config,args.target)
+		camera.session(config,target)
 	elif config['sensor'].lower().startswith('spencer'):
 		from libcanon import Canon 
-		camera = Canon(config,args.target)
+		camera = Canon(config,target)
 		print("Giving Canon 1 seconds to initialize")
 		time.sleep(1)
 	else:
 		print("Not sure which camera to initialize")
 		exit()
 	print("Camera initialized")
-	if args.verbose:
-		camera.showInfo()
+	return camera
+
+def initLights(config,sleep=time.sleep,simulate=False):
 	print("Initializing light array")
-	if config['lights'].lower() == 'octopusbluetooth':
-	 	lightArray = lights.OctopusBluetooth()
+	if simulate or config['lights'].lower().startswith('simulat'):
+		lightArray = lights.Simulated(config['lights'],sleep)
+	elif config['lights'].lower() == 'octopusbluetooth':
+		lightArray = lights.OctopusBluetooth(config.get('bluetoothwritecommand',False))
 	elif config['lights'].lower().startswith('octopus'):
 		lightArray = lights.Octopus()
 		print("Giving the Octopus another 2 seconds to open")
@@ -89,29 +98,263 @@ if __name__ == "__main__":
 		time.sleep(2)
 	elif config['lights'].lower().startswith('nolight'):
 		lightArray = lights.Overhead()
-	print("Starting shot list")
-	for shot in shotlist:
-		if shot.strip() == "" or shot.strip().startswith('log:') or shot.strip().startswith('#'):
+	lightArray.settle = lights.readSettle(config['lights'])
+	return lightArray
+
+def runShotlist(camera,lightArray,shotlist,timing,sleep=time.sleep,dryRun=False,overlap=False,autoExposure=None,strobe=False,clock=None):
+	if overlap:
+		from libsession import SessionController
+		SessionController(camera,lightArray,sleep,dryRun,autoExposure,strobe,clock).runShotlist(shotlist,timing)
+		return
+	if strobe:
+		strobe = lights.Strobe(lightArray,camera)
+	print("Starting shot list for %s"%(camera.target))
+	timing.rewind()
+	lit = None # light left on because the next shot uses it too, which saves turning it off, on, and waiting for it to settle
+	try:
+		for index, (light,wheel,exposure) in enumerate(shotlist):
+			shot = timing.begin(light,wheel,exposure)
+			if shot.done:
+				print("Already have Light = %s | Wheel = %s | Exposure = %s"%(light,wheel,exposure))
+				continue
+			frames = libshotlist.frames(exposure)
+			print("\aShooting Light = %s | Wheel = %s | Exposure = %s%s"%(light,wheel,exposure,' | Frames = %s'%(frames) if frames > 1 else ''))
+			camera.shot = shot
+			if lit and lit != light:
+				with phase(shot,'lightoff'):
+					lightArray.off()
+				lit = None
+			with phase(shot,'wheel'):
+				camera.setWheel(wheel)
+			armed = False
+			try: # the light goes off even if the shot fails
+				if lit != light:
+					with phase(shot,'lighton'):
+						lightArray.manualon(light)
+					lit = light
+					with phase(shot,'settle'):
+						seconds = lights.waitReady(lightArray,light,sleep)
+					if dryRun:
+						shot.add('settle',seconds) # the virtual clock does not take any time
+				if autoExposure:
+					exposure = autoExposure.converge(light,wheel,exposure)
+				if frames > 1:
+					shot.record['frames'] = frames
+					camera.shoot(light,wheel,exposure,frames) # the light stays on for every frame, even with --strobe
+				elif strobe:
+					strobe.arm(exposure,shot)
+					armed = True
+					camera.shoot(light,wheel,exposure)
+				else:
+					camera.shoot(light,wheel,exposure)
+			except BaseException:
+				if armed:
+					strobe.finish()
+				else:
+					lightArray.off()
+				lit = None
+				raise
+			if armed:
+				strobe.finish()
+				lit = None
+			elif index+1 == len(shotlist) or shotlist[index+1][0] != light:
+				with phase(shot,'lightoff'):
+					lightArray.off()
+				lit = None
+			camera.shot = None
+			shot.release()
+	finally:
+		if lit:
+			lightArray.off()
+
+def calibrateSettle(camera,lightArray,shotlist,window=3,tolerance=0.02):
+	"""
+	Takes quick binned test frames from the moment each light turns on and finds when the level stops changing
+	Returns settle seconds for each light, for lights.waitReady
+	"""
+	from libstats import FrameStats
+	settle = {}
+	for light,wheel,exposure in shotlist:
+		if light in settle:
 			continue
-		light,wheel,exposure = shot.strip().split(sep='-')
-		exposure = int(exposure.strip('ms'))
-		print("\aShooting Light = %s | Wheel = %s | Exposure = %s"%(light,wheel,exposure))
 		camera.setWheel(wheel)
-		if False:
-			lightProcess = Process(target=lightArray.manualon,args=(light)) #lightProcess = Process(target=lightArray.on,args=(light,exposure)) 
-			lightProcess.start()
-		if True:
-			lightArray.manualon(light)
-		time.sleep(0.5) # Give the lights a head start
-		camera.shoot(light,wheel,exposure)
-		if False:
-			lightProcess.join()
-			lightProcess = Process(target=lightArray.off) 
-			lightProcess.start()
-			lightProcess.join()
-		if True:
-			lightArray.off()
+		lightArray.off()
+		camera.beginTestFrames(4)
+		testExposure = min(int(exposure),800) # at most 50 ms once binned
+		camera.testFrame(testExposure) # first frame after changing mode can be slow
+		levels = []
+		start = time.monotonic()
+		lightArray.manualon(light)
+		while time.monotonic() - start < window:
+			frameStart = time.monotonic() - start
+			levels.append((frameStart,FrameStats(camera.testFrame(testExposure)).mean))
+		lightArray.off()
+		camera.endTestFrames()
+		final = levels[-1][1]
+		stable = len(levels) - 1
+		while stable > 0 and abs(levels[stable-1][1] - final) <= tolerance*final:
+			stable -= 1
+		settle[light] = round(levels[stable][0],2)
+		print("Light %s is steady %.2f seconds after turning on (%s test frames)"%(light,settle[light],len(levels)))
+	return settle
+
+def nextTarget(targets,batch,ask=input):
+	if len(targets) > 0:
+		return targets.pop(0)
+	if batch:
+		return ask("Next target (leave blank to finish): ").strip()
+	return ''
+
+def closeDevices(camera,lightArray,daemon=None):
+	if daemon:
+		daemon.release() # the daemon keeps them open and cooled for the next session
+	else:
+		camera.close()
+		lightArray.close()
+
+def main(args,daemon=None,ask=input):
+	"""
+	One session, run here or in the capture daemon, which passes itself to reuse the camera and lights it keeps open
+	"""
+	if daemon and args.dry_run:
+		daemon = None # simulated devices are made fresh for every dry run
+	if args.configuration and args.configuration.lower().endswith('.yaml'):
+		with open(args.configuration,'r') as unparsedyaml:
+			config = yaml.load(unparsedyaml,Loader=yaml.SafeLoader)
+	else:
+		print("It is necessary to specify a configuration file")
+		exit()
+	if args.shotlist and (args.shotlist.lower().endswith('.yaml') or args.shotlist.lower().endswith('txt')):
+		if not libpreflight.check(config,args.shotlist,max(1,len(args.target or [])),disk=not args.dry_run,strobe=args.strobe):
+			print("Fix the problems above before opening the camera")
+			exit()
+		shotlist = libshotlist.readShotlist(args.shotlist)
+	elif args.calibrate_wheel:
+		shotlist = []
+	else: 
+		print("It is necessary to specify a shotlist file")
+		exit()
+	if args.schedule:
+		shotlist,originalSeconds,scheduledSeconds = libshotlist.schedule(shotlist,str(config.get('model',config['sensor'])),switchSeconds=config.get('lightswitchcost',libshotlist.lightSwitchSeconds))
+		libshotlist.printSchedule(shotlist,originalSeconds,scheduledSeconds)
+	targets = list(args.target) if args.target else []
+	if args.dry_run and not targets:
+		targets = ['DryRun']
+	if (args.calibrate_settle or args.calibrate_wheel) and not targets:
+		targets = ['Calibration'] # nothing is saved under the target
+	target = nextTarget(targets,args.batch,ask)
+	if not target:
+		print("Let's just stop here because you're going to need to specify a target before we can save anything.")
+		exit()
+	sleep = time.sleep
+	clock = None
+	if args.dry_run:
+		import libsim
+		print("Dry run: simulating %s and %s lights, saving to a temporary directory"%(config['sensor'],config['lights']))
+		clock = libsim.Clock(virtual=True)
+		sleep = clock.sleep
+		config = dict(config,basepath=tempfile.mkdtemp(prefix='JubPalDryRun'))
+		dryRunStart = time.monotonic()
+	camera = daemon.openCamera(config,target) if daemon else initCamera(config,target,clock)
+	if args.pipeline:
+		from libwriter import FrameWriter
+		writer = FrameWriter(config.get('pipelinedepth',2))
+		camera.writer = writer
+	if args.verbose:
+		camera.showInfo()
+	lightArray = daemon.openLights(config) if daemon else initLights(config,sleep,args.dry_run)
+	if args.calibrate_wheel:
+		if hasattr(camera,'calibrateWheel'):
+			camera.calibrateWheel()
+		else:
+			print("There is no filter wheel to calibrate on %s"%(config['sensor']))
+	if args.calibrate_settle:
+		if args.dry_run or not hasattr(camera,'testFrame'):
+			print("Settle calibration needs a real camera that can take test frames (QHY or Flir)")
+		else:
+			lights.writeSettle(config['lights'],calibrateSettle(camera,lightArray,shotlist))
+	if args.calibrate_wheel or args.calibrate_settle:
+		closeDevices(camera,lightArray,daemon)
+		return
+	if hasattr(camera,'waitCooled'):
+		if shotlist:
+			camera.setWheel(shotlist[0][1]) # the first wheel move also overlaps with cooling
+		camera.waitCooled()
+	autoExposure = None
+	if args.autoexposure:
+		if hasattr(camera,'testFrame'):
+			from libautoexposure import AutoExposure
+			autoExposure = AutoExposure(camera,config)
+		else:
+			print("Auto exposure is not available for %s, using exposures from the shotlist"%(config['sensor']))
+	while target:
+		camera.target = target
+		journal = Journal(path.join(config['basepath'],target),args.shotlist,args.resume)
+		timing = SessionTiming(path.join(config['basepath'],target),journal)
+		if args.dry_run:
+			targetStart = (clock.slept,time.monotonic(),clock.synthesizing)
+		for attempt in range(2):
+			try:
+				runShotlist(camera,lightArray,shotlist,timing,sleep,args.dry_run,args.overlap,autoExposure,args.strobe,clock)
+				break
+			except Exception as e:
+				print("Shot list for %s failed: %s"%(target,e))
+				try:
+					lightArray.off() # before anything else, so the artifact is not lit while the camera reopens and cools
+				except Exception as offError:
+					print("Problem turning off %s: %s"%(type(lightArray).__name__,offError))
+				if attempt > 0:
+					print("Giving up on %s after reopening the camera and lights once"%(target))
+					break
+				print("Reopening camera and lights and starting %s again"%(target))
+				if args.pipeline:
+					writer.flush()
+				if daemon:
+					daemon.closeDevices()
+					camera = daemon.openCamera(config,target)
+					lightArray = daemon.openLights(config)
+				else:
+					for device in (camera,lightArray):
+						try:
+							device.close()
+						except Exception as e:
+							print("Problem closing %s: %s"%(type(device).__name__,e))
+					camera = initCamera(config,target,clock)
+					lightArray = initLights(config,sleep,args.dry_run)
+				if hasattr(camera,'waitCooled'):
+					camera.waitCooled() # the reopened camera starts cooling again from ambient
+				if args.pipeline:
+					camera.writer = writer
+				if autoExposure:
+					autoExposure.camera = camera
+		if args.pipeline:
+			writer.flush() # the timing summary includes the background writes
+		if args.dry_run:
+			timing.close(clock.slept - targetStart[0] + time.monotonic() - targetStart[1] - clock.synthesizing + targetStart[2])
+		else:
+			timing.close()
+		target = nextTarget(targets,args.batch,ask)
+	if autoExposure and args.save_shotlist:
+		autoExposure.writeShotlist(args.save_shotlist)
 	if args.worklights and config['lights'].lower().startswith('octopus'):
 		lightArray.manualon('white6500')
-	camera.close()
-	lightArray.close()
+	if args.pipeline:
+		writer.close() # every frame must be on disk before the camera and its report are closed
+	closeDevices(camera,lightArray,daemon)
+	if args.dry_run:
+		measured = time.monotonic() - dryRunStart - clock.synthesizing
+		print("Estimated session duration is %.0f seconds (%.1f minutes): %.0f seconds modeled for camera, wheel, and lights and %.0f seconds measured for analyzing and saving"%(clock.slept+measured,(clock.slept+measured)/60,clock.slept,measured))
+		shutil.rmtree(config['basepath'])
+
+if __name__ == "__main__":
+	print("Gathering arguments from the command line")
+	args = getArguments()
+	client = None
+	if not args.dry_run and not args.local:
+		import libdaemon
+		client = libdaemon.connect()
+	if client:
+		client.capture(args)
+		client.close()
+	else:
+		main(args)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+import argparse
+import yaml
+import libdaemon
+
+def getArguments():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-c','--configuration') # open and cool the camera in this profile now instead of at the first session
+	parser.add_argument('--status',action='store_true') # report the devices the running daemon has open
+	parser.add_argument('--stop',action='store_true') # close the devices and stop the running daemon
+	return parser.parse_args()
+
+if __name__ == "__main__":
+	args = getArguments()
+	if args.status or args.stop:
+		client = libdaemon.connect()
+		if not client:
+			print("No capture daemon is running")
+			exit()
+		if args.stop:
+			client.request('stop')
+			print("Capture daemon stopped")
+		else:
+			for key, value in client.request('status').items():
+				print("%s: %s"%(key,value))
+		client.close()
+		exit()
+	config = None
+	if args.configuration:
+		with open(args.configuration,'r') as unparsedyaml:
+			config = yaml.load(unparsedyaml,Loader=yaml.SafeLoader)
+	libdaemon.Daemon().serve(config)
@@ -1,12 +1,130 @@
 #!/usr/bin/env python
-import sys
+import argparse
 import os
 import glob
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from skimage import io, img_as_uint, img_as_ubyte, img_as_float32
 import numpy as np
+import libstack
+import libdarkmodel
 
 verbose = 4
+cachebudget = 2048 # megabytes of decoded median darks kept in memory, override with --cache
+stackbudget = libstack.stackBudget # megabytes for each band of darks while stacking, override with --stack-memory
+stackmode = 'auto' # how darks are combined into a median dark, override with --stack
+modelhot = False # fit a hot pixel term in dark models as well, set with --hot
+
+def darkkey(filename):
+    """
+    Camera, gain, filter, and exposure that a dark must share with a frame, from the fields of a filename
+    """
+    fields = filename.split('-')
+    passfilter = fields[6]
+    if not 'Bayer' in passfilter:
+      passfilter = 'NoFilter'
+    return (fields[1],fields[4],passfilter,fields[7])
+
+def newest(filelist):
+    return max(filelist,key=lambda filename: (filename.split('-')[-1],filename))
+
+class DarkLibrary():
+    """
+    Median darks in LensCap/Median and dark models in LensCap/Model, listed once per run
+    Darks read or synthesized from a model are kept decoded as float32 while they fit in the memory budget
+    The least recently used dark is dropped first, and when more than one median dark or model suits a frame the newest by filename timestamp is used
+    """
+    def __init__(self,basepath,budget=cachebudget):
+        self.basepath = basepath
+        self.directory = os.path.join(basepath,'LensCap','Median')
+        self.budget = budget*2**20
+        self.cache = OrderedDict()
+        self.cachedbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.index = {}
+        self.warned = set()
+        self.nodarks = set() # keys with no darks in LensCap/Raw to take a median of
+        self.nomodel = set() # cameras, gains, and filters without darks at enough exposures for a model
+        for darkmedianfile in sorted(glob.glob(os.path.join(self.directory,'LensCap-*-*-F*-*-NoLight-*-*-*.tif'))):
+            self.add(os.path.basename(darkmedianfile))
+        self.modeldirectory = os.path.join(basepath,'LensCap','Model')
+        self.models = {}
+        for darkmodelfile in sorted(glob.glob(os.path.join(self.modeldirectory,'LensCap-*-*-F*-*-NoLight-*-Model-*.tif'))):
+            self.addmodel(os.path.basename(darkmodelfile))
+
+    def add(self,darkmedianfile):
+        self.index.setdefault(darkkey(darkmedianfile),[]).append(darkmedianfile)
+
+    def find(self,key):
+        medianlist = self.index.get(key,[])
+        if len(medianlist) == 0:
+            return None
+        if len(medianlist) > 1 and key not in self.warned and verbose > 2:
+            self.warned.add(key)
+            print("More than one suitable median dark file found, using the newest of %s"%(', '.join(sorted(medianlist))))
+        return newest(medianlist)
+
+    def addmodel(self,darkmodelfile):
+        self.models.setdefault(darkkey(darkmodelfile)[:3],[]).append(darkmodelfile)
+
+    def findmodel(self,group):
+        """
+        Newest dark model for a camera, gain, and filter, or None
+        """
+        modellist = self.models.get(group,[])
+        if len(modellist) == 0:
+            return None
+        return newest(modellist)
+
+    def recall(self,name):
+        if name in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(name)
+            return self.cache[name]
+        self.misses += 1
+        return None
+
+    def remember(self,name,image):
+        image.flags.writeable = False # shared by every frame that uses it
+        while self.cache and self.cachedbytes + image.nbytes > self.budget:
+            evicted, evictedimage = self.cache.popitem(last=False)
+            self.cachedbytes -= evictedimage.nbytes
+        if image.nbytes <= self.budget:
+            self.cache[name] = image
+            self.cachedbytes += image.nbytes
+        return image
+
+    def dark(self,darkmedianfile):
+        darkmedianimage = self.recall(darkmedianfile)
+        if darkmedianimage is not None:
+            return darkmedianimage
+        if verbose > 3:
+            settings = libstack.readSettings(os.path.join(self.directory,darkmedianfile))
+            print("Reading median dark %s%s"%(darkmedianfile,' (%s)'%(', '.join('%s %s'%(key,value) for key, value in settings.items())) if settings else ''))
+        return self.remember(darkmedianfile,img_as_float32(io.imread(os.path.join(self.directory,darkmedianfile))))
+
+    def modeldark(self,key):
+        """
+        Dark for the exposure of key synthesized from the newest dark model, or None without a model or with an exposure that is not in milliseconds
+        """
+        darkmodelfile = self.findmodel(key[:3])
+        seconds = libdarkmodel.exposureSeconds(key[3])
+        if darkmodelfile is None or seconds is None:
+            return None
+        name = darkmodelfile+':'+key[3]
+        darkimage = self.recall(name)
+        if darkimage is not None:
+            return darkimage
+        if verbose > 2:
+            print("Synthesizing a %s dark from dark model %s"%(key[3],darkmodelfile))
+        return self.remember(name,libdarkmodel.synthesize(os.path.join(self.modeldirectory,darkmodelfile),seconds))
+
+    def report(self):
+        if verbose > 2 and self.hits + self.misses > 0:
+            print("Darks for %s: %s read from disk or synthesized, %s reused from memory"%(self.basepath,self.misses,self.hits))
 
 def createmediandarkfile(basepath,darkmedianfile):
     if verbose > 2:
@@ -22,24 +140,22 @@ def createmediandarkfile(basepath,darkmedianfile):
     filemask = os.path.join(basepath,'LensCap','Raw','LensCap-'+camera+'-*-F*-'+gain+'-*-'+passfilter+'-'+exposure+'-*.tif')
     darklist = glob.glob(filemask)
     if len(darklist) == 0:
-        if verbose > 0:
-            print("No suitable dark files found. Take ten shots of LensCap-%s-NoLens-FNone-%s-NoLight-%s-%s-<timestamp>.tif"%(camera,gain,passfilter,exposure))
+        if verbose > 2:
+            print("No dark files at %s in LensCap/Raw, will try a dark model"%(exposure))
         return
-    cube = []
     for darkfile in darklist:
         if verbose > 2:
             print("Reading %s"%(darkfile))
-        img = io.imread(darkfile)
-        if img.dtype == np.uint16:
-            bpp = 16
-        elif img.dtype == np.uint8:
-            bpp = 8
-        img = img_as_float32(img)
-        cube.append(img)
-    cube = np.array(cube) 
+    if libstack.openFrame(darklist[-1]).dtype == np.uint8:
+        bpp = 8
+    else:
+        bpp = 16
+    settings = libstack.stackSettings(stackmode,len(darklist))
     if verbose > 3:
-        print("Calculating median")
-    median = np.median(cube,axis=0)
+        print("Calculating %s of %s darks"%(settings['stack'],len(darklist)))
+    median = libstack.stack(darklist,settings,img_as_float32,stackbudget) # same float32 result as stacking the whole cube, a band of rows at a time
+    if verbose > 2:
+        print("Peak memory so far is %.0f MB"%(libstack.peakMemory()))
     if bpp == 16:
         median = img_as_uint(median)
     elif bpp == 8:
@@ -47,38 +163,110 @@ def createmediandarkfile(basepath,darkmedianfile):
     if not os.path.exists(os.path.join(basepath,'LensCap','Median')):
         if verbose > 2:
             print("Creating directory %s"%(os.path.join(basepath,'LensCap','Median')))
-        os.mkdir(os.path.join(basepath,'LensCap','Median'))
-    io.imsave(os.path.join(basepath,'LensCap','Median',darkmedianfile),median,check_contrast=False)
+        os.makedirs(os.path.join(basepath,'LensCap','Median'),exist_ok=True) # workers building other darks may get there first
+    libstack.saveStack(os.path.join(basepath,'LensCap','Median',darkmedianfile),median,settings) # the description records how the darks were combined
 
-def createdarksubtractedfile(basepath,targetfile):
-    if verbose > 2:
-        print("Subtracting median dark noise from Raw/%s for directory DarkSubtracted/"%(targetfile))
-    fields = targetfile.split('-')
-    target = fields[0]
+def newmediandarkfile(key):
+    camera, gain, passfilter, exposure = key
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return 'LensCap-'+camera+'-NoLens-FNone-'+gain+'-NoLight-'+passfilter+'-'+exposure+'-'+timestamp+'.tif'
+
+def buildmediandark(basepath,darkmedianfile):
+    """
+    Returns darkmedianfile if it could be created from LensCap/Raw, otherwise None
+    """
+    createmediandarkfile(basepath,darkmedianfile)
+    if not os.path.exists(os.path.join(basepath,'LensCap','Median',darkmedianfile)):
+        return None
+    return darkmedianfile
+
+def createdarkmodelfile(basepath,darkmodelfile):
+    """
+    Fits bias and dark current (and with --hot a hot pixel term) to every dark in LensCap/Raw with the camera, gain, and filter of darkmodelfile, whatever the exposure
+    """
+    fields = darkmodelfile.split('-')
     camera = fields[1]
     gain = fields[4]
     passfilter = fields[6]
-    if not 'Bayer' in passfilter:
-      passfilter = 'NoFilter'
-    exposure = fields[7]
-    filemask = os.path.join(basepath,'LensCap','Median','LensCap-'+camera+'-*-F*-'+gain+'-NoLight-'+passfilter+'-'+exposure+'-*.tif')
-    medianlist = glob.glob(filemask)
-    if len(medianlist) == 0:
+    filemask = os.path.join(basepath,'LensCap','Raw','LensCap-'+camera+'-*-F*-'+gain+'-*-'+passfilter+'-*-*.tif')
+    darklist = []
+    seconds = []
+    for darkfile in sorted(glob.glob(filemask)):
+        exposure = libdarkmodel.exposureSeconds(darkkey(os.path.basename(darkfile))[3])
+        if exposure is not None:
+            darklist.append(darkfile)
+            seconds.append(exposure)
+    if len(set(seconds)) < 2:
         if verbose > 2:
-            print("No suitable median dark file found, will try to create")
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        darkmedianfile = 'LensCap-'+camera+'-NoLens-FNone-'+gain+'-NoLight-'+passfilter+'-'+exposure+'-'+timestamp+'.tif'
-        createmediandarkfile(basepath,darkmedianfile)
-        if not os.path.exists(os.path.join(basepath,'LensCap','Median',darkmedianfile)):
-            return
-        createdarksubtractedfile(basepath,targetfile)
-        return
-    elif len(medianlist) > 1:
-        if verbose > 0:
-            print("More than one suitable median dark file found. Think about what to do in this situation and edit the code.")
+            print("Dark files at %s exposures in LensCap/Raw, a dark model needs two or more"%(len(set(seconds))))
         return
+    if verbose > 2:
+        print("Fitting dark model LensCap/Model/%s to %s dark files at %s seconds"%(darkmodelfile,len(darklist),', '.join('%g'%(exposure) for exposure in sorted(set(seconds)))))
+    coefficients, settings = libdarkmodel.fitModel(darklist,seconds,modelhot,img_as_float32,stackbudget)
+    if libstack.openFrame(darklist[-1]).dtype == np.uint8:
+        bpp = 8
+    else:
+        bpp = 16
+    if verbose > 2:
+        print("Fitted %s with a root mean square residual of %.2f counts"%(' + '.join(settings['model']),settings['residual']*(2**bpp-1)))
+        print("Peak memory so far is %.0f MB"%(libstack.peakMemory()))
+    os.makedirs(os.path.join(basepath,'LensCap','Model'),exist_ok=True)
+    libdarkmodel.saveModel(os.path.join(basepath,'LensCap','Model',darkmodelfile),coefficients,settings)
+
+def newdarkmodelfile(group):
+    return newmediandarkfile(group+('Model',))
+
+def builddarkmodel(basepath,darkmodelfile):
+    """
+    Returns darkmodelfile if it could be fitted to LensCap/Raw, otherwise None
+    """
+    createdarkmodelfile(basepath,darkmodelfile)
+    if not os.path.exists(os.path.join(basepath,'LensCap','Model',darkmodelfile)):
+        return None
+    return darkmodelfile
+
+def modeldark(basepath,key,library):
+    """
+    Dark synthesized for key, fitting a dark model first if there is none yet, or None
+    """
+    group = key[:3]
+    if library.findmodel(group) is None and group not in library.nomodel:
+        darkmodelfile = builddarkmodel(basepath,newdarkmodelfile(group))
+        if darkmodelfile is None:
+            library.nomodel.add(group)
+        else:
+            library.addmodel(darkmodelfile)
+    return library.modeldark(key)
+
+def nodarks(key):
+    if verbose > 0:
+        camera, gain, passfilter, exposure = key
+        print("No suitable dark files found. Take ten shots of LensCap-%s-NoLens-FNone-%s-NoLight-%s-%s-<timestamp>.tif, or a few at each of two or more exposures for a dark model"%(camera,gain,passfilter,exposure))
+
+def createdarksubtractedfile(basepath,targetfile,library=None):
+    if verbose > 2:
+        print("Subtracting median dark noise from Raw/%s for directory DarkSubtracted/"%(targetfile))
+    if library is None:
+        library = DarkLibrary(basepath)
+    target = targetfile.split('-')[0]
+    key = darkkey(targetfile)
+    darkmedianfile = library.find(key)
+    if darkmedianfile is None and key not in library.nodarks:
+        if verbose > 2:
+            print("No suitable median dark file found, will try to create")
+        darkmedianfile = buildmediandark(basepath,newmediandarkfile(key))
+        if darkmedianfile is None:
+            library.nodarks.add(key)
+        else:
+            library.add(darkmedianfile)
+    if darkmedianfile is None:
+        darkmedianimage = modeldark(basepath,key,library) # synthesized for an exposure without darks of its own
+        if darkmedianimage is None:
+            nodarks(key)
+            return False
+    else:
+        darkmedianimage = library.dark(darkmedianfile)
     targetimage = io.imread(os.path.join(basepath,target,'Raw',targetfile))
-    darkmedianimage = io.imread(os.path.join(basepath,'LensCap','Median',medianlist[0]))
     if verbose > 3:
         print("Target image range is %s - %s"%(np.min(targetimage),np.max(targetimage)))
         print("Median image range is %s - %s"%(np.min(darkmedianimage),np.max(darkmedianimage)))
@@ -87,7 +275,6 @@ def createdarksubtractedfile(basepath,targetfile):
     else:
         bpp = 16
     targetimage = img_as_float32(targetimage)
-    darkmedianimage = img_as_float32(darkmedianimage)
     darksubtractedimage = targetimage - darkmedianimage
     formermin = np.min(darksubtractedimage)
     formermax = np.max(darksubtractedimage)
@@ -104,6 +291,70 @@ def createdarksubtractedfile(basepath,targetfile):
     if verbose > 0:
         print("Corrected range is %s - %s"%(np.min(darksubtractedimage),np.max(darksubtractedimage)))
     io.imsave(os.path.join(basepath,target,'DarkSubtracted',targetfile),darksubtractedimage,check_contrast=False)
+    return True
+
+workerlibraries = {}
+workerbudget = cachebudget
+
+def startworker(budget,stack,mode,kappa,hot):
+    global workerbudget, stackbudget, stackmode, modelhot
+    workerbudget = budget
+    stackbudget = stack
+    stackmode = mode
+    libstack.kappa = kappa
+    modelhot = hot
+
+def subtractinworker(basepath,targetfile):
+    """
+    Each worker process keeps its own dark library, and files are handed out in runs that share a dark
+    """
+    if basepath not in workerlibraries:
+        workerlibraries[basepath] = DarkLibrary(basepath,workerbudget)
+    return createdarksubtractedfile(basepath,targetfile,workerlibraries[basepath])
+
+def subtractbatch(tasks,jobs,budget):
+    """
+    Builds every missing median dark first, one worker for each, so no two workers build the same one
+    Then fits a dark model for each camera, gain, and filter that still lacks a dark and a model, and subtracts across the pool
+    Returns the tasks that were done
+    """
+    libraries = {}
+    missing = {}
+    for basepath, targetfile in tasks:
+        if basepath not in libraries:
+            libraries[basepath] = DarkLibrary(basepath,budget)
+        key = darkkey(targetfile)
+        if libraries[basepath].find(key) is None and (basepath,key) not in missing:
+            missing[(basepath,key)] = newmediandarkfile(key)
+    with ProcessPoolExecutor(max_workers=jobs,initializer=startworker,initargs=(max(1,budget//jobs),max(1,stackbudget//jobs),stackmode,libstack.kappa,modelhot)) as executor:
+        if missing:
+            if verbose > 2:
+                print("Building %s median darks with %s workers"%(len(missing),jobs))
+            basepaths = [basepath for basepath, key in missing]
+            for basepath, darkmedianfile in zip(basepaths,executor.map(buildmediandark,basepaths,missing.values())):
+                if darkmedianfile:
+                    libraries[basepath].add(darkmedianfile)
+        models = {}
+        for basepath, key in missing:
+            if libraries[basepath].find(key) is None and libraries[basepath].findmodel(key[:3]) is None and (basepath,key[:3]) not in models:
+                models[(basepath,key[:3])] = newdarkmodelfile(key[:3])
+        if models:
+            if verbose > 2:
+                print("Fitting %s dark models with %s workers"%(len(models),jobs))
+            basepaths = [basepath for basepath, group in models]
+            for basepath, darkmodelfile in zip(basepaths,executor.map(builddarkmodel,basepaths,models.values())):
+                if darkmodelfile:
+                    libraries[basepath].addmodel(darkmodelfile)
+        for basepath, key in missing:
+            if libraries[basepath].find(key) is None and libraries[basepath].findmodel(key[:3]) is None:
+                nodarks(key)
+        tasks = [(basepath,targetfile) for basepath, targetfile in tasks if libraries[basepath].find(darkkey(targetfile)) or libraries[basepath].findmodel(darkkey(targetfile)[:3])]
+        tasks.sort(key=lambda task: (task[0],darkkey(task[1]),task[1]))
+        if verbose > 2:
+            print("Subtracting darks from %s files with %s workers"%(len(tasks),jobs))
+        chunksize = max(1,len(tasks)//(4*jobs))
+        done = executor.map(subtractinworker,[basepath for basepath, targetfile in tasks],[targetfile for basepath, targetfile in tasks],chunksize=chunksize)
+        return [task for task, success in zip(tasks,done) if success]
 
 if __name__ == "__main__":
     """
@@ -111,10 +362,27 @@ if __name__ == "__main__":
     """
     if verbose > 3:
         print("Taking list of files to be dark subtracted from the command line")
-    if len(sys.argv) == 1:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files',nargs='*')
+    parser.add_argument('--cache',type=int,default=cachebudget) # megabytes of median darks to keep decoded in memory, shared among jobs
+    parser.add_argument('-j','--jobs',type=int,default=1) # worker processes, each subtracting a file at a time
+    parser.add_argument('--stack-memory',type=int,default=stackbudget) # megabytes for each band of darks while stacking
+    parser.add_argument('--stack',choices=libstack.modes,default=stackmode) # how darks are combined into a new median dark
+    parser.add_argument('--kappa',type=float,default=libstack.kappa) # standard deviations at which --stack sigmaclip rejects a value
+    parser.add_argument('--model',action='store_true') # fit the dark models for these files again, as after taking more darks
+    parser.add_argument('--hot',action='store_true') # fit a hot pixel term in the square of the exposure as well
+    args = parser.parse_args()
+    modelhot = args.hot
+    stackbudget = args.stack_memory
+    stackmode = args.stack
+    libstack.kappa = args.kappa
+    if len(args.files) == 0:
         print("This command takes a filename or glob of filenames as a command line argument")
         exit()
-    for argument in sys.argv[1:]:
+    libraries = {}
+    tasks = []
+    modelgroups = set()
+    for argument in args.files:
         if os.path.isdir(argument) and verbose > 0:
             print("%s is a directory. For now we're expecting image files. Adding /*.tif might do the trick."%(argument))
         elif not "Raw" in argument and verbose > 0:
@@ -128,6 +396,7 @@ if __name__ == "__main__":
             targetpath = os.path.dirname(rawpath)
             basepath = os.path.dirname(targetpath)
             darksubtracteddir = os.path.join(targetpath,'DarkSubtracted')
+            modelgroups.add((basepath,darkkey(targetfile)[:3]))
             if not os.path.exists(darksubtracteddir):
                 if verbose > 2:
                     print("Creating directory %s"%(darksubtracteddir))
@@ -136,5 +405,24 @@ if __name__ == "__main__":
                 if verbose > 2:
                     print("Dark subtracted file already exists for %s"%(targetfile))
             else:
-                createdarksubtractedfile(basepath,targetfile)
+                tasks.append((basepath,targetfile))
+    if args.model:
+        for basepath, group in sorted(modelgroups):
+            builddarkmodel(basepath,newdarkmodelfile(group))
+    start = time.monotonic()
+    if args.jobs > 1:
+        done = subtractbatch(tasks,args.jobs,args.cache)
+    else:
+        done = []
+        for basepath, targetfile in tasks:
+            if basepath not in libraries:
+                libraries[basepath] = DarkLibrary(basepath,args.cache)
+            if createdarksubtractedfile(basepath,targetfile,libraries[basepath]):
+                done.append((basepath,targetfile))
+        for library in libraries.values():
+            library.report()
+    seconds = time.monotonic() - start
+    if done and verbose > 0:
+        megabytes = sum(os.path.getsize(os.path.join(basepath,targetfile.split('-')[0],'Raw',targetfile)) for basepath, targetfile in done)/2**20
+        print("Dark subtracted %s files (%.0f MB) in %.1f seconds: %.2f files per second, %.1f MB per second"%(len(done),megabytes,seconds,len(done)/seconds,megabytes/seconds))
 
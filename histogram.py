@@ -2,6 +2,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
 from skimage import io
+from libstats import FrameStats
 
 verbose = False
 warnblowout = True
@@ -22,22 +23,23 @@ def generate_histogram(inpath,outpath):
     if verbose:
         print("Reading %s"%(inpath))
     img = io.imread(inpath)
-    img = np.reshape(img,-1)
+    stats = FrameStats(img) # one pass for the statistics and the histogram
     if verbose:
-        print("Image has %s pixels ranging from %s to %s with a median of %s and standard deviation of %s"%(img.shape[0],np.min(img),np.max(img),int(np.median(img)),int(np.std(img))))
+        print("Image has %s pixels ranging from %s to %s with a median of %s and standard deviation of %s"%(stats.count,stats.min,stats.max,int(stats.median()),int(stats.std)))
     if 'LensCap-QHYmini' in inpath or 'LensCap-Canon' in inpath:
         range = (0,2**12-1)
     elif 'LensCap-' in inpath:
         range = (0,2**10-1)
     elif img.dtype == 'uint16' and warnblowout:
         range = (0,2**16-1)
-        percent = 100 * np.count_nonzero(img > 0.95*range[1]) / img.shape[0]
+        percent = 100 * stats.above(0.95*range[1]) / stats.count
         if percent > 0.5:
             print("%s%% of pixels are greater than 95%% of range in %s"%(int(percent),inpath))
     else:
         range = None
     plt.clf()
-    plt.hist(img,bins=256,range=range)
+    counts, edges = stats.histogram(bins=256,range=range)
+    plt.stairs(counts,edges,fill=True) # same bars as plt.hist(img,bins=256,range=range)
 		# plt.tick_params(axis='y',labelleft=False)
     plt.margins(x=0)
     plt.savefig(outpath)
@@ -0,0 +1,65 @@
+import libshotlist
+from libstats import FrameStats
+from libtiming import phase
+
+"""
+Closed loop exposure for capture.py -a
+With the wheel set and the light on, the camera takes quick binned test frames and scales the exposure until the 98th percentile reaches the exposure goal without saturating
+Cameras that can do this have beginTestFrames(), testFrame(exposure), and endTestFrames(); testFrame takes the full resolution exposure and returns a frame with the levels a full resolution frame would have
+Each light and filter pair converges once, and later shots with the same pair start from the converged exposure
+"""
+
+verbose = 3
+testBinning = 4 # same as liveview.py
+maxIterations = 6
+tolerance = 0.05 # stop once the next exposure would change less than this fraction
+maxSaturatedPct = 0.5 # percent of pixels above warnsaturation tolerated in a test frame
+maxStep = 8 # largest factor to change exposure by in one iteration
+minExposure = 1 # milliseconds
+maxExposure = 30000 # milliseconds, override with autoexposuremax in the profile
+
+class AutoExposure():
+	def __init__(self,camera,config):
+		self.camera = camera
+		self.exposureGoal = camera.exposureGoal
+		self.warnsaturation = camera.warnsaturation
+		self.maxExposure = config.get('autoexposuremax',maxExposure)
+		self.converged = {}
+		self.shots = [] # every shot as taken, for writing out a new shotlist
+
+	def converge(self,light,wheel,exposure):
+		frames = libshotlist.frames(exposure)
+		exposure = self.converged.get((light,wheel),int(exposure))
+		with phase(self.camera.shot,'autoexposure'):
+			self.camera.beginTestFrames(testBinning)
+			try:
+				for iteration in range(maxIterations):
+					stats = FrameStats(self.camera.testFrame(exposure))
+					p98 = stats.percentile(98)
+					saturated = stats.saturatedpct(self.warnsaturation)
+					if saturated > maxSaturatedPct:
+						factor = 1/maxStep if p98 >= self.warnsaturation else 1/2 # the 98th percentile cannot tell how far past saturation the highlights are
+					else:
+						factor = min(maxStep,max(1/maxStep,self.exposureGoal/max(p98,1)))
+					nextExposure = int(round(min(self.maxExposure,max(minExposure,exposure*factor))))
+					print("Test frame %s at %sms has 98th percentile %.0f and %.1f%% saturated, next %sms"%(iteration+1,exposure,p98,saturated,nextExposure)) if verbose > 3 else None
+					if abs(nextExposure-exposure) <= tolerance*exposure:
+						break
+					if iteration < maxIterations-1:
+						exposure = nextExposure
+				else:
+					print("Auto exposure for %s through %s did not converge in %s test frames, keeping the last exposure tested"%(light,wheel,maxIterations))
+			finally:
+				self.camera.endTestFrames()
+		print("Auto exposure for %s through %s is %sms"%(light,wheel,exposure))
+		self.converged[(light,wheel)] = exposure
+		if self.camera.shot:
+			self.camera.shot.record['exposure'] = exposure # the timing log matches the filename
+		self.shots.append((light,wheel,libshotlist.Exposure(exposure,frames)))
+		return exposure
+
+	def writeShotlist(self,shotlistPath):
+		with open(shotlistPath,'w') as shotlist:
+			for light,wheel,exposure in self.shots:
+				shotlist.write(libshotlist.formatShot(light,wheel,exposure)+'\n')
+		print("Wrote converged exposures to %s"%(shotlistPath))
@@ -6,6 +6,8 @@ from datetime import datetime
 from io import BytesIO
 from os import makedirs, path
 from skimage import io
+from libtiming import phase
+from libstats import FrameStats
 from edsdk import (CameraCommand, ObjectEvent, FileCreateDisposition, Access, EdsObject, PropID, PropertyEvent, SaveTo, ISOSpeedCamera, AEMode, AFMode, Av, Tv, ImageQuality)
 
 verbose = 2
@@ -32,6 +34,8 @@ class Canon:
 		# not using third stops: 20\" (1/3), 10\" (1/3), 6\" (1/3), 0\"3 (1/3), 1/6 (1/3), 1/10 (1/3), 1/20 (1/3)
 		def __init__(self,config,target):
 			self.reports = []
+			self.writer = None # capture.py attaches a FrameWriter for pipelined sessions
+			self.shot = None # capture.py attaches a ShotTiming for each shot
 			self.config = config
 			self.target = target
 			print("Initializing...")
@@ -88,12 +92,17 @@ class Canon:
 					height = 5000 # 4655 # 4640*2 # not super precise because of compression, 3168 on t1i, 4640 on r7
 					self.imageData = bytes(width*height*2) # 1 for 8-bit, 2 for 16-bit, 3 for three channels of 8-bit	.... won't need all that space because compressed
 					self.memStream = edsdk.CreateMemoryStreamFromPointer(self.imageData)
-				edsdk.SendCommand(self.camera,CameraCommand.TakePicture,0)
-				time.sleep(waitForCamera)
-				edsdk.GetEvent()
-				if True:
+				with phase(self.shot,'exposure'):
+						edsdk.SendCommand(self.camera,CameraCommand.TakePicture,0)
+						time.sleep(waitForCamera)
+				with phase(self.shot,'transfer'): # the download happens in callback_object during GetEvent
+						edsdk.GetEvent()
+				timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+				if self.writer:
+					self.writer.submit(self.saveRawData,self.imageData,self.light,self.wheel,self.exposure,timestamp,self.shot,shot=self.shot) # imageData is allocated fresh for each download
+				elif True:
 					with rawpy.imread(BytesIO(self.imageData)) as raw:
-						self.saveRawFunction(raw) #img = raw.raw_image.copy() print("We now have a numpy object named img with shape %s dtype %s range %s - %s"%(img.shape,img.dtype,np.min(img),np.max(img)))
+						self.saveRawFunction(raw,self.light,self.wheel,self.exposure,timestamp,self.shot) #img = raw.raw_image.copy() print("We now have a numpy object named img with shape %s dtype %s range %s - %s"%(img.shape,img.dtype,np.min(img),np.max(img)))
 				if False:
 					with rawpy.imread(BytesIO(self.imageData)) as raw: 
 							self.saveRawFunction(raw) 
@@ -178,12 +187,20 @@ class Canon:
 				edsdk.Download(object_handle,dir_item_info["size"],self.memStream)
 				print("Download Complete") if verbose > 5 else None
 				edsdk.DownloadComplete(object_handle)
-		def saveRawFunction(self,raw):
+		def saveRawData(self,imageData,light,wheel,exposure,timestamp,shot=None):
+				with rawpy.imread(BytesIO(imageData)) as raw:
+						self.saveRawFunction(raw,light,wheel,exposure,timestamp,shot)
+		def saveRawFunction(self,raw,light=None,wheel=None,exposure=None,timestamp=None,shot=None):
+				light = self.light if light is None else light # libchdk calls without the shot details
+				wheel = self.wheel if wheel is None else wheel
+				exposure = self.exposure if exposure is None else exposure
+				shot = self.shot if shot is None else shot
+				if timestamp is None:
+						timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 				bayerChannels = {0:'BayerR',1:'BayerG',2:'BayerB'}
 				directory = path.join(self.config['basepath'],self.target,'Raw')
 				if not path.exists(directory):
 						makedirs(directory)
-				timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 				fileExtension = 'tif'
 				# wheel = 'BayerRGGB'
 				if 'cool' in self.config:
@@ -196,17 +213,19 @@ class Canon:
 						self.config['lens'],
 						self.config['aperture'],
 						gainDesc,
-						self.light,
-						self.wheel,
-						str(self.exposure)+'ms',
+						light,
+						wheel,
+						str(exposure)+'ms',
 						timestamp+'.'+fileExtension])
 				outfilePath = path.join(directory,outfileName)
 				print(f"Saving {outfilePath}") if verbose > 3 else None
 				img = raw.raw_image.copy()
-				io.imsave(path.join(directory,outfilePath),img,check_contrast=False)
-				suggestion = exposureGoal*int(self.exposure)/np.percentile(img,98)
-				saturatedpct = 100 * np.count_nonzero(img > warnsaturation) / np.count_nonzero(img)
-				report = f"{self.exposure:_>6}_|{suggestion:_>6.0f}_|{np.percentile(img,98):_>6.0f}_|{saturatedpct:_>5.1f}%_|{np.min(img):_>6}_|{np.max(img):_>6}_|{self.light:_^17}|{self.wheel:_^17}" 
+				with phase(shot,'write'):
+						io.imsave(path.join(directory,outfilePath),img,check_contrast=False)
+				if shot:
+						shot.saved(outfilePath)
+				with phase(shot,'statistics'):
+						report = FrameStats(img).report(exposure,light,wheel,exposureGoal,warnsaturation)
 				print(reportheader)
 				print(report)
 				self.reports.append(report)
@@ -217,22 +236,26 @@ class Canon:
 				output_bps=16 # 8 or 16 bits per sample
 				adjust_maximum_thr = 0.0 # no observed effect
 				print("Settings:\n\thalf_size: %s\n\tno_auto_bright: %s\n\tno_auto_scale: %s\n\tgamma (power, slope): %s\n\toutput_bps: %s"%(half_size,no_auto_bright,no_auto_scale,gamma,output_bps)) if verbose > 4 else None
-				raw = raw.postprocess(half_size=half_size,no_auto_bright=no_auto_bright,gamma=gamma,no_auto_scale=no_auto_scale,output_bps=output_bps,adjust_maximum_thr=adjust_maximum_thr)
+				with phase(shot,'postprocess'):
+						raw = raw.postprocess(half_size=half_size,no_auto_bright=no_auto_bright,gamma=gamma,no_auto_scale=no_auto_scale,output_bps=output_bps,adjust_maximum_thr=adjust_maximum_thr)
 				height,width,channels = raw.shape
 				print("Processed image is %s pixels high, %s pixels wide, and %s channels deep with each pixel described with %s data"%(height,width,channels,raw.dtype)) if verbose > 4 else None
 				for channel in range(channels):
-						wheel = self.wheel.strip('BayerRGGB')+bayerChannels[channel]
+						channelWheel = wheel.strip('BayerRGGB')+bayerChannels[channel]
 						outfileName = '-'.join([
 								self.target,
 								self.config['sensor'],
 								self.config['lens'],
 								self.config['aperture'],
 								gainDesc,
-								self.light,
-								wheel,
-								str(self.exposure)+'ms',
+								light,
+								channelWheel,
+								str(exposure)+'ms',
 								timestamp+'.'+fileExtension])
 						outfilePath = path.join(directory,outfileName)
 						print(f"Saving {outfilePath}") if verbose > 3 else None
-						io.imsave(path.join(directory,outfilePath),raw[:,:,channel],check_contrast=False)
+						with phase(shot,'write'):
+								io.imsave(path.join(directory,outfilePath),raw[:,:,channel],check_contrast=False)
+						if shot:
+								shot.saved(outfilePath)
 
@@ -2,6 +2,7 @@ from math import log2
 from libcanon import Canon
 import rawpy
 from io import BytesIO
+from libtiming import phase
 try:
 	import chdkptp
 except:
@@ -21,6 +22,7 @@ pip install .
 class Chdk():
 	def __init__(self):
 		self.reports = []
+		self.shot = None # capture.py attaches a ShotTiming for each shot
 		try:
 			self.device = chdkptp.ChdkDevice(chdkptp.list_devices()[0])
 		except:
@@ -85,7 +87,8 @@ class Chdk():
 		else:
 			real_iso= int(self.config['gain'])
 		aperturevalueapex96 = 2*log2(int(self.config['aperture'].strip('F')))
-		dng = self.device.shoot(dng=True,shutter_speed=timevalueapex96,real_iso=real_iso,aperture=aperturevalueapex96)
+		with phase(self.shot,'exposure'): # includes streaming the DNG back from the camera
+			dng = self.device.shoot(dng=True,shutter_speed=timevalueapex96,real_iso=real_iso,aperture=aperturevalueapex96)
 		with rawpy.imread(BytesIO(dng)) as raw: 
 			Canon.saveRawFunction(self,raw) 
 		if False:
@@ -0,0 +1,381 @@
+import os
+import sys
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client as Connect
+from os import makedirs, path
+
+"""
+Keeps the camera, filter wheel, and lights open between sessions, started with capturedaemon.py
+The camera stays cooled, so capture.py and liveview.py reach it in milliseconds instead of opening the SDK and cooling again
+Clients connect over a Unix socket in ~/.cache/JubPalCapture and must be able to read daemon.key, which only the user can
+capture.py sends its command line and the session runs in the daemon, with output and questions relayed to the terminal
+liveview.py asks for binned test frames, so the camera never leaves single frame mode and a session can begin between frames
+One client uses the devices at a time; live view waits while a session runs
+"""
+
+verbose = 3
+socketPath = path.expanduser('~/.cache/JubPalCapture/daemon.sock')
+keyPath = path.expanduser('~/.cache/JubPalCapture/daemon.key')
+cameraKeys = ('sensor','model','width','height','bpp','readout','gain','cool','buffers') # profile fields that need the camera opened again when they change
+lightKeys = ('lights','bluetoothwritecommand')
+
+def readKey(create=False):
+	if create:
+		makedirs(path.dirname(keyPath),exist_ok=True)
+		key = os.urandom(32)
+		with os.fdopen(os.open(keyPath,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o600),'wb') as keyFile:
+			keyFile.write(key)
+		return key
+	with open(keyPath,'rb') as keyFile:
+		return keyFile.read()
+
+def connect():
+	"""
+	Client for the running daemon, or None so the caller opens the devices itself
+	"""
+	if not path.exists(socketPath):
+		return None
+	try:
+		return Client(Connect(socketPath,'AF_UNIX',authkey=readKey()))
+	except (OSError,EOFError,AuthenticationError) as e:
+		print("Capture daemon is not answering (%s), opening devices directly"%(e)) if verbose > 2 else None
+		return None
+
+class Client():
+	def __init__(self,connection):
+		self.connection = connection
+
+	def request(self,command,*args):
+		self.connection.send((command,args))
+		while True:
+			kind, value = self.connection.recv()
+			if kind == 'print':
+				sys.stdout.write(value)
+			elif kind == 'input':
+				self.connection.send(input(value))
+			elif kind == 'error':
+				raise RuntimeError(value)
+			else:
+				return value
+
+	def capture(self,args):
+		for name in ('configuration','shotlist','save_shotlist'):
+			if getattr(args,name):
+				setattr(args,name,path.abspath(getattr(args,name))) # the daemon may have started in another directory
+		print("Running the session in the capture daemon, which has the devices open")
+		self.request('capture',args)
+
+	def close(self):
+		self.connection.close()
+
+class LiveCamera():
+	"""
+	What liveview.py calls on a camera, answered with binned test frames from the daemon's camera
+	Gain, read mode, and bit depth stay as the daemon's profile set them, and frames arrive as 8 bit
+	"""
+	def __init__(self,client):
+		self.client = client
+		self.name = client.request('cameraName')
+		self.id = self.name.encode() # liveview.py decodes the QHY id
+		self.binXY = 1
+		self.roi = None
+		self.exposureMS = 16
+
+	def connect(self,mode):
+		pass
+
+	def SetReadMode(self,readmode):
+		pass
+
+	def SetGain(self,gain):
+		pass
+
+	def SetBit(self,bpp):
+		pass
+
+	def SetBinMode(self,binX,binY):
+		self.binXY = binX
+		self.roi = None
+
+	def SetROI(self,newX,newY,newW,newH):
+		self.roi = (newX,newY,newW,newH)
+
+	def SetExposure(self,exposureMS):
+		self.exposureMS = exposureMS*self.binXY**2 # liveview.py divides by the binned pixels, test frames take the full resolution exposure
+
+	def setWheel(self,wheel):
+		self.client.request('setWheel',wheel)
+
+	def BeginLive(self):
+		pass
+
+	def GetLiveFrame(self):
+		return self.client.request('liveFrame',self.binXY,self.roi,self.exposureMS)
+
+	def StopLive(self):
+		pass
+
+	def close(self):
+		try:
+			self.client.request('endLive')
+		finally:
+			self.client.close() # the camera stays open in the daemon
+
+class Relay():
+	"""
+	Stands in for stdout and input() in the daemon while a client's session runs
+	"""
+	def __init__(self,connection):
+		self.connection = connection
+		self.lock = threading.Lock()
+		self.connected = True
+
+	def write(self,text):
+		with self.lock:
+			if self.connected:
+				try:
+					self.connection.send(('print',text))
+				except OSError:
+					self.connected = False # the session goes on without the terminal that started it
+			if not self.connected:
+				sys.__stdout__.write(text)
+		return len(text)
+
+	def flush(self):
+		pass
+
+	def ask(self,prompt):
+		with self.lock:
+			self.connection.send(('input',prompt))
+			return self.connection.recv()
+
+class Output():
+	"""
+	Installed once as sys.stdout by serve(): text from the session's thread, and from threads the session starts (writers, telemetry), goes to the session's client
+	Everything else, such as other clients waiting for live view, goes to the daemon's own output
+	"""
+	def __init__(self):
+		self.relay = None
+		self.session = None
+		self.before = set()
+		self.lock = threading.Lock()
+
+	def attach(self,relay):
+		self.before = set(threading.enumerate()) # threads of the daemon and other clients, already running
+		self.session = threading.current_thread()
+		self.relay = relay
+
+	def detach(self):
+		self.relay = None
+		self.session = None
+		self.before = set()
+
+	def owns(self,thread):
+		return thread is self.session or (thread not in self.before and not thread.name.startswith('client'))
+
+	def write(self,text):
+		relay = self.relay
+		if relay and self.owns(threading.current_thread()):
+			return relay.write(text)
+		with self.lock:
+			return sys.__stdout__.write(text)
+
+	def flush(self):
+		sys.__stdout__.flush()
+
+class Daemon():
+	def __init__(self):
+		self.lock = threading.RLock() # held for a whole session or a single live view frame
+		self.camera = None
+		self.lightArray = None
+		self.cameraConfig = None
+		self.lightConfig = None
+		self.live = None # binning and ROI of live view test frames, None in full resolution
+		self.running = True
+		self.listener = None
+		self.output = Output()
+
+	def same(self,config,opened,keys):
+		return opened is not None and all(config.get(key) == opened.get(key) for key in keys)
+
+	def openCamera(self,config,target):
+		import capture
+		if self.camera and not self.same(config,self.cameraConfig,cameraKeys):
+			print("Profile changes the camera settings, so the daemon opens the camera again")
+			self.closeCamera()
+		if self.camera is None:
+			self.camera = capture.initCamera(config,target)
+		else:
+			print("Camera is already open in the capture daemon")
+			self.endLive()
+			self.camera.config = config # basepath, lens, and other names for the files
+			self.camera.target = target
+		self.cameraConfig = config
+		return self.camera
+
+	def openLights(self,config):
+		import capture
+		import lights
+		if self.lightArray and not self.same(config,self.lightConfig,lightKeys):
+			self.closeLights()
+		if self.lightArray is None:
+			self.lightArray = capture.initLights(config)
+		else:
+			self.lightArray.settle = lights.readSettle(config['lights']) # may have been calibrated since
+		self.lightConfig = config
+		return self.lightArray
+
+	def release(self):
+		"""
+		End of a session: detach what capture.py attached but keep the devices open
+		"""
+		if self.camera:
+			self.camera.writer = None
+			self.camera.shot = None
+			if hasattr(self.camera,'wheelModel'):
+				self.camera.wheelModel.save()
+			if hasattr(self.camera,'reports'):
+				self.camera.reports = [] # each report was printed as its frame was saved
+
+	def closeCamera(self):
+		if self.camera:
+			try:
+				self.camera.close()
+			except Exception as e:
+				print("Problem closing %s: %s"%(type(self.camera).__name__,e))
+		self.camera = None
+		self.cameraConfig = None
+		self.live = None
+
+	def closeLights(self):
+		if self.lightArray:
+			try:
+				self.lightArray.close()
+			except Exception as e:
+				print("Problem closing %s: %s"%(type(self.lightArray).__name__,e))
+		self.lightArray = None
+		self.lightConfig = None
+
+	def closeDevices(self):
+		with self.lock:
+			self.closeCamera()
+			self.closeLights()
+
+	def capture(self,connection,args):
+		import capture
+		relay = Relay(connection)
+		with self.lock:
+			self.output.attach(relay)
+			try:
+				capture.main(args,self,relay.ask)
+			except SystemExit:
+				pass # capture.py stops with exit() when something is wrong, which must not stop the daemon
+			finally:
+				self.output.detach()
+
+	def cameraName(self):
+		if self.camera is None:
+			raise RuntimeError("The capture daemon has no camera open, start it with -c PROFILE or run a session first")
+		if hasattr(self.camera,'id'):
+			return bytes(self.camera.id).decode()
+		return str(self.cameraConfig['sensor'])
+
+	def liveFrame(self,binXY,roi,exposureMS):
+		with self.lock:
+			self.cameraName() # only to fail clearly without a camera
+			if not hasattr(self.camera,'testFrame'):
+				raise RuntimeError("%s cannot take test frames for live view"%(self.cameraConfig['sensor']))
+			if self.live != (binXY,roi):
+				self.camera.beginTestFrames(binXY)
+				if roi and hasattr(self.camera,'SetROI'):
+					self.camera.SetROI(*roi)
+				self.live = (binXY,roi)
+			frame = self.camera.testFrame(exposureMS)
+		if frame.dtype.itemsize > 1:
+			frame = (frame >> 8*(frame.dtype.itemsize-1)).astype('uint8') # liveview.py shows 8 bit frames
+		return frame
+
+	def endLive(self):
+		with self.lock:
+			if self.live:
+				self.camera.endTestFrames()
+				self.live = None
+
+	def setWheel(self,wheel):
+		with self.lock:
+			self.cameraName()
+			self.camera.setWheel(wheel)
+
+	def status(self):
+		status = {'camera':'none','lights':'none'}
+		if self.camera:
+			status['camera'] = self.cameraName()
+			if 'cool' in self.cameraConfig:
+				status['cooling to'] = self.cameraConfig['cool']
+			if getattr(self.camera,'telemetry',None):
+				status.update(self.camera.telemetry.latest())
+		if self.lightArray:
+			status['lights'] = self.lightConfig['lights']
+		status['busy'] = 'live view' if self.live else 'no'
+		return status
+
+	def handle(self,connection):
+		with connection:
+			while True:
+				try:
+					command, args = connection.recv()
+				except (EOFError,OSError):
+					return
+				try:
+					if command == 'capture':
+						result = self.capture(connection,*args)
+					elif command in ('cameraName','liveFrame','endLive','setWheel','status'):
+						result = getattr(self,command)(*args)
+					elif command == 'stop':
+						connection.send(('result',None))
+						self.stop()
+						return
+					else:
+						raise ValueError("Unknown command %s"%(command))
+					connection.send(('result',result))
+				except (EOFError,OSError):
+					return
+				except Exception as e:
+					print("Problem with %s: %s"%(command,e))
+					connection.send(('error',"%s: %s"%(type(e).__name__,e)))
+
+	def stop(self):
+		print("Stopping the capture daemon")
+		self.running = False # serve() closes the devices once any session has finished
+		Connect(socketPath,'AF_UNIX',authkey=readKey()).close() # wakes serve() from accept()
+
+	def serve(self,config=None):
+		if path.exists(socketPath):
+			client = connect()
+			if client:
+				client.close()
+				print("A capture daemon is already running, stop it with capturedaemon.py --stop")
+				return
+			os.unlink(socketPath) # left by a daemon that did not stop cleanly
+		sys.stdout = self.output
+		if config:
+			self.openCamera(config,'Daemon') # begin cooling now rather than at the first session
+			self.openLights(config)
+		makedirs(path.dirname(socketPath),exist_ok=True)
+		self.listener = Listener(socketPath,'AF_UNIX',authkey=readKey(create=True))
+		print("Capture daemon listening on %s"%(socketPath))
+		try:
+			while self.running:
+				try:
+					connection = self.listener.accept()
+				except AuthenticationError:
+					print("Refused a client without the daemon key")
+					continue
+				threading.Thread(target=self.handle,args=(connection,),name='client',daemon=True).start() # Output leaves threads named client out of a session
+		finally:
+			self.listener.close()
+			self.closeDevices()
+
+if __name__ == "__main__":
+	print("This is not meant to be run but called from capturedaemon.py")
@@ -0,0 +1,73 @@
+import re
+import numpy as np
+import libstack
+
+"""
+Dark frames modelled pixel by pixel as bias plus dark current times the exposure, and optionally a hot pixel term in the square of the exposure
+Every dark in LensCap/Raw for a camera, gain, and filter takes part, whatever its exposure, so two or three dark exposures can stand in for a set at every exposure
+The least squares fit is a single matrix product per band of rows: the pseudoinverse of the exposures times the stack of darks
+Coefficients are saved as float32 pages of one TIFF, in the units of img_as_float32 per second, with the fit described as JSON
+"""
+
+verbose = 3
+terms = ('bias','current','hot') # coefficients of 1, seconds, and seconds squared
+
+def exposureSeconds(exposure):
+	""" Seconds from the exposure field of a filename such as 12000ms, or None for anything else """
+	match = re.fullmatch(r'(\d+(?:\.\d+)?)ms',exposure)
+	if not match:
+		return None
+	return float(match.group(1))/1000
+
+def designMatrix(seconds,count):
+	return np.vander(np.asarray(seconds,dtype=np.float64),count,increasing=True)
+
+def fitModel(filePaths,seconds,hot=False,convert=None,budget=libstack.stackBudget):
+	"""
+	Returns coefficients (bias, current, and hot if asked for and there are three or more exposures) as a float32 array of pages, and the settings describing the fit
+	convert (such as img_as_float32) is applied to each band of darks before fitting
+	"""
+	count = 3 if hot and len(set(seconds)) >= 3 else 2
+	if hot and count < 3:
+		print("The hot pixel term needs darks at three or more exposures, fitting bias and dark current only") if verbose > 1 else None
+	design = designMatrix(seconds,count)
+	solve = np.linalg.pinv(design).astype(np.float32)
+	design = design.astype(np.float32)
+	frames = [libstack.openFrame(filePath) for filePath in filePaths]
+	rows = libstack.bandRows(frames,budget)
+	height = frames[0].shape[0]
+	print("Fitting %s to %s darks in bands of %s rows"%(' + '.join(terms[:count]),len(frames),rows)) if verbose > 3 else None
+	coefficients = None
+	squares = 0.0
+	for top in range(0,height,rows):
+		band = np.stack([convert(frame[top:top+rows]) if convert else np.asarray(frame[top:top+rows],dtype=np.float32) for frame in frames])
+		fit = np.tensordot(solve,band,axes=1)
+		if coefficients is None:
+			coefficients = np.empty((count,height)+fit.shape[2:],dtype=np.float32)
+		coefficients[:,top:top+rows] = fit
+		band -= np.tensordot(design,fit,axes=1) # residuals
+		band = band.ravel()
+		squares += float(np.dot(band,band))
+		del band, fit
+	settings = {'model':list(terms[:count]),'frames':len(frames),'exposures':sorted(set(seconds)),'residual':(squares/coefficients[0].size/len(frames))**0.5}
+	return coefficients, settings
+
+def saveModel(filePath,coefficients,settings):
+	libstack.saveStack(filePath,coefficients,settings)
+
+def synthesize(filePath,seconds):
+	"""
+	Dark for an exposure of seconds from a saved model, float32 clipped to the range of img_as_float32
+	"""
+	coefficients = libstack.openFrame(filePath)
+	settings = libstack.readSettings(filePath)
+	exposures = settings.get('exposures')
+	if exposures and not min(exposures) <= seconds <= max(exposures) and verbose > 2:
+		print("%s seconds is outside the %s to %s seconds of the darks in the model, so the dark is extrapolated"%(seconds,min(exposures),max(exposures)))
+	dark = np.array(coefficients[0],dtype=np.float32)
+	for power in range(1,len(coefficients)):
+		dark += coefficients[power]*np.float32(seconds**power)
+	return np.clip(dark,0,1,out=dark)
+
+if __name__ == "__main__":
+	print("This is not meant to be run but called from darksubtract.py")
@@ -5,6 +5,9 @@ import PySpin
 import numpy as np
 from skimage import io
 import math
+from libtiming import phase
+from libstats import FrameStats
+import libstack
 
 """
 https://softwareservices.flir.com/FFY-U3-04S2/latest/Model/public/ImageFormatControl.html
@@ -18,12 +21,20 @@ Acquisition Modes
 
 verbose = True
 reportheader = '___MS__|_MAYBE_|_98THP_|__SAT__|__MIN__|__MAX__|______LIGHT______|______FILTER_____'
+exposureGoal = 0.85*2**16 # might be 2**12 on flir
+warnsaturation = 64000 # saturation might be lower on flir
+maxExposure = 29900 # milliseconds
 
 class Flir():
 
 	def __init__(self):
 		print("Initializing Flir Camera")
 		self.rotate = False
+		self.writer = None # capture.py attaches a FrameWriter for pipelined sessions
+		self.shot = None # capture.py attaches a ShotTiming for each shot
+		self.exposureGoal = exposureGoal
+		self.warnsaturation = warnsaturation
+		self.testBinning = 1
 		self.system = PySpin.System.GetInstance()
 		self.cam_list = self.system.GetCameras()
 		if self.cam_list.GetSize() == 0:
@@ -95,37 +106,53 @@ class Flir():
 			np.rot90(img,2)
 		return img
 
-	def shoot(self,light,wheel,exposure):
-		if exposure > 29900:
+	def shoot(self,light,wheel,exposure,frames=1):
+		if exposure > maxExposure:
 			print("Flir cannot accept exposure times longer than 29.9 seconds. Capping...")
-			exposure = 29900
+			exposure = maxExposure
 		self.SetExposure(exposure)# self.SetExposure(self,exposure)
-		if True:
-			self.camera.BeginAcquisition()
-		print("Shooting for %sms"%(exposure))
-		image_result = self.camera.GetNextImage()
-		while image_result.IsIncomplete():
-			print("Waiting for complete image")
-			time.sleep(1)
-			image_result = self.camera.GetNextImage()
-		img = image_result.GetNDArray()
-		image_result.Release()
-		if True:
+		if frames > 1:
+			accumulator = libstack.Accumulator()
+		for frame in range(frames):
+			self.camera.BeginAcquisition() # SingleFrame mode delivers one image per acquisition
+			print("Shooting for %sms"%(exposure))
+			with phase(self.shot,'exposure'): # GetNextImage returns once the frame has been read out and transferred
+				image_result = self.camera.GetNextImage()
+				while image_result.IsIncomplete():
+					print("Waiting for complete image")
+					time.sleep(1)
+					image_result = self.camera.GetNextImage()
+			with phase(self.shot,'transfer'):
+				img = image_result.GetNDArray()
+				image_result.Release()
 			self.camera.EndAcquisition()
+			if frames > 1:
+				with phase(self.shot,'postprocess'):
+					accumulator.add(img)
+		timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+		if frames > 1:
+			if self.writer:
+				self.writer.submit(libstack.saveAverage,self.saveFrame,accumulator,light,wheel,exposure,timestamp,self.shot,shot=self.shot)
+			else:
+				libstack.saveAverage(self.saveFrame,accumulator,light,wheel,exposure,timestamp,self.shot)
+			return
 		if self.rotate:
 			np.rot90(img,2)
+		if self.writer:
+			self.writer.submit(self.saveFrame,img,light,wheel,exposure,timestamp,self.shot,shot=self.shot) # GetNDArray returns a copy, so no need to copy again
+		else:
+			self.saveFrame(img,light,wheel,exposure,timestamp,self.shot)
+
+	def saveFrame(self,img,light,wheel,exposure,timestamp,shot=None):
+		with phase(shot,'statistics'):
+			report = FrameStats(img).report(exposure,light,wheel,exposureGoal,warnsaturation)
 		if True:
-			exposureGoal = 0.85*2**16 # might be 2**12 on flir
-			suggestion = exposureGoal*int(exposure)/np.percentile(img,98)
-			saturatedpct = 100 * np.count_nonzero(img > 64000) / np.count_nonzero(img) # might be lower on flir
-			report = f"{exposure:_>6}_|{suggestion:_>6.0f}_|{np.percentile(img,98):_>6.0f}_|{saturatedpct:_>5.1f}%_|{np.min(img):_>6}_|{np.max(img):_>6}_|{light:_^17}|{wheel:_^17}" # report = f"{light:-<10}{wheel:-<10}{exposure:->5}ms pixel values range {np.min(img):>5} - {np.max(img):5} with 98th percentile of {np.percentile(img,98):>5.0f} and {saturatedpct:>3.1f}% of pixels above 64000, consider {suggestion:5.0f}"
 			print(reportheader)
 			print(report)
 			self.reports.append(report)
 		directory = os.path.join(self.config['basepath'],self.target,'Raw')
 		if not os.path.exists(directory):
 			os.makedirs(directory)
-		timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 		fileExtension = 'tif'
 		if 'cool' in self.config:
 			gainDesc = 'gain'+str(self.config['gain'])+'_'+str(self.config['cool']).strip('-')
@@ -143,7 +170,11 @@ class Flir():
 			timestamp+'.'+fileExtension])
 		outfilePath = os.path.join(directory,outfileName)
 		print("Saving %s"%(outfilePath))
-		io.imsave(outfilePath,img,check_contrast=False)
+		with phase(shot,'write'):
+			io.imsave(outfilePath,img,check_contrast=False)
+		if shot:
+			shot.saved(outfilePath)
+		return outfilePath
 
 	def close(self):
 		print(reportheader)
@@ -163,6 +194,29 @@ class Flir():
 			self.system.ReleaseInstance()
 			self.system = None
 
+	def beginTestFrames(self,binXY):
+		self.testBinning = binXY
+		self.SetBinMode(binXY,binXY)
+		self.SetROI(0,0,self.camera.WidthMax.GetValue(),self.camera.HeightMax.GetValue())
+
+	def testFrame(self,exposure):
+		""" Binning sums pixels, so a fraction of the exposure gives the levels of a full resolution frame """
+		self.SetExposure(max(1,min(maxExposure,int(exposure/self.testBinning**2))))
+		self.camera.BeginAcquisition()
+		image_result = self.camera.GetNextImage()
+		while image_result.IsIncomplete():
+			time.sleep(1)
+			image_result = self.camera.GetNextImage()
+		img = image_result.GetNDArray()
+		image_result.Release()
+		self.camera.EndAcquisition()
+		return img
+
+	def endTestFrames(self):
+		self.testBinning = 1
+		self.SetBinMode(1,1)
+		self.SetROI(0,0,self.camera.WidthMax.GetValue(),self.camera.HeightMax.GetValue())
+
 	def setWheel(self,wheelNewPosition): 
 		print("No wheel to set")
 
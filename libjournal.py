@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+from os import path
+
+"""
+Append-only record of finished shots, one journal for each target and shotlist, kept next to Raw
+A shot is recorded only after every file it writes is on disk, along with the size and modification time of each file, which cost nothing to read back
+With capture.py --resume, shots in the journal whose files still match are skipped, and anything else is taken again
+Journals written before modification times were recorded hold a SHA-256 of each file instead, which is checked only when resuming
+Shotlists can repeat a light, filter, and exposure, so shots are identified by those three and how many times they have come up before
+"""
+
+verbose = 3
+hashChunk = 2**24
+
+def sha256(filePath):
+	digest = hashlib.sha256()
+	with open(filePath,'rb') as f:
+		for block in iter(lambda: f.read(hashChunk),b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def tiffComplete(filePath):
+	"""
+	False if the image data a TIFF points to runs past the end of the file, as when writing was interrupted
+	Without tifffile the file cannot be checked and is left in place
+	"""
+	try:
+		import tifffile
+	except ImportError:
+		print("tifffile is not installed, so %s cannot be checked for an interrupted write"%(filePath))
+		return True
+	try:
+		with tifffile.TiffFile(filePath) as tif:
+			page = tif.pages[0]
+			end = max(offset+count for offset, count in zip(page.dataoffsets,page.databytecounts))
+	except Exception:
+		return False
+	return end <= path.getsize(filePath)
+
+def fileEntry(filePath):
+	""" Size and modification time of a saved file, read from the directory without reading the file """
+	stat = os.stat(filePath)
+	return {'path':filePath,'bytes':stat.st_size,'mtime':stat.st_mtime_ns}
+
+class Journal():
+	def __init__(self,directory,shotlistPath,resume=False):
+		if not path.exists(directory):
+			os.makedirs(directory)
+		self.directory = directory
+		self.path = path.join(directory,'journal-'+path.splitext(path.basename(shotlistPath))[0]+'.jsonl')
+		self.lock = threading.Lock()
+		self.done = {}
+		if resume:
+			self.load()
+
+	def key(self,light,wheel,exposure,occurrence):
+		return "%s-%s-%sms#%s"%(light,wheel,exposure,occurrence)
+
+	def load(self):
+		if not path.exists(self.path):
+			print("Nothing to resume for %s, starting from the first shot"%(self.path))
+			return
+		journaled = set()
+		with open(self.path,'r') as journal:
+			for line in journal:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					continue # last line cut short by a crash
+				journaled.update(f['path'] for f in entry['files'])
+				if all(self.unchanged(f) for f in entry['files']):
+					self.done[entry['key']] = entry
+				else:
+					print("Files for %s have changed since they were saved, so it will be taken again"%(entry['key']))
+					self.setAside([f['path'] for f in entry['files'] if path.exists(f['path'])])
+		raw = path.join(self.directory,'Raw')
+		if path.exists(raw):
+			unjournaled = [path.join(raw,name) for name in sorted(os.listdir(raw)) if name.lower().endswith(('.tif','.tiff')) and path.join(raw,name) not in journaled]
+			self.setAside([filePath for filePath in unjournaled if not tiffComplete(filePath)])
+		print("Resuming with %s shots already done"%(len(self.done)))
+
+	def unchanged(self,journaled):
+		if not path.exists(journaled['path']) or path.getsize(journaled['path']) != journaled['bytes']:
+			return False
+		if 'mtime' in journaled:
+			return os.stat(journaled['path']).st_mtime_ns == journaled['mtime']
+		return sha256(journaled['path']) == journaled['sha256']
+
+	def setAside(self,filePaths):
+		for filePath in filePaths:
+			print("Renaming incomplete %s to %s.partial"%(filePath,filePath))
+			os.replace(filePath,filePath+'.partial')
+
+	def isDone(self,light,wheel,exposure,occurrence):
+		return self.key(light,wheel,exposure,occurrence) in self.done
+
+	def complete(self,record):
+		"""
+		Called with a shot's timing record once its files are saved
+		"""
+		if len(record['files']) == 0:
+			return # nothing saved, so the shot is not done
+		light,wheel,exposure = record['key']
+		entry = {
+			'key':self.key(light,wheel,exposure,record['occurrence']),
+			'light':light,
+			'wheel':wheel,
+			'exposure':record['exposure'], # differs from the shotlist with auto exposure
+			'finished':datetime.now().isoformat(timespec='seconds'),
+			'telemetry':record.get('telemetry',{}), # sensor temperature for matching darks
+			'files':[fileEntry(filePath) for filePath in record['files']]
+		}
+		with self.lock:
+			with open(self.path,'a') as journal:
+				journal.write(json.dumps(entry)+'\n')
+				journal.flush()
+				os.fsync(journal.fileno())
+		self.done[entry['key']] = entry
@@ -1,10 +1,13 @@
 import time
-from os import path
+from os import makedirs, path
 from datetime import datetime
 import numpy as np
 from pixelinkWrapper import *
 from skimage import io
 import sys
+from libtiming import phase
+from libstats import FrameStats
+import libstack
 
 class Pixelink():
 	hCamera = None
@@ -14,6 +17,8 @@ class Pixelink():
 		print("Initializing Pixelink Camera")
 		self.hCamera = None
 		self.frame = None
+		self.writer = None # capture.py attaches a FrameWriter for pipelined sessions
+		self.shot = None # capture.py attaches a ShotTiming for each shot
 		ret = PxLApi.initialize(0)
 		self.hCamera = ret[1]
 
@@ -108,41 +113,62 @@ class Pixelink():
 		params[0] = exposureMS/1000 # confirm that takes seconds
 		ret = PxLApi.setFeature(self.hCamera, PxLApi.FeatureId.EXPOSURE, PxLApi.FeatureFlags.MANUAL, params)
 
-	def shoot(self,light,wheel,exposure):
+	def shoot(self,light,wheel,exposure,frames=1):
 		self.SetExposure(exposure)
 		print(f"{np.max(self.frame)=} {self.frame.shape=} {self.frame.dtype=}")
-		for i in range(5): # try five times to get a frame
-			print("Trying to get a frame")
-			ret = PxLApi.getNextNumPyFrame(self.hCamera,self.frame)
-			if PxLApi.apiSuccess(ret[0]):
-				print("Successfully captured a frame")
-				break
+		if frames > 1:
+			accumulator = libstack.Accumulator()
+		for frame in range(frames):
+			with phase(self.shot,'exposure'): # the stream delivers the frame already read out
+				for i in range(5): # try five times to get a frame
+					print("Trying to get a frame")
+					ret = PxLApi.getNextNumPyFrame(self.hCamera,self.frame)
+					if PxLApi.apiSuccess(ret[0]):
+						print("Successfully captured a frame")
+						break
+					else:
+					 	if PxLApi.ReturnCode.ApiStreamStopped == ret[0]:
+					 		print("Stream is stopped")
+					 	elif PxLApi.ReturnCode.ApiNoCameraAvailableError == ret[0]:
+					 		print("No camera avilable")
+					 	elif PxLApi.ReturnCode.ApiBufferTooSmall == ret[0]:
+					 		print("Buffer too small")
+					 	else:
+					 		print(f"{ret=}")
+			if True:
+				print(f"{np.max(self.frame)=} {self.frame.shape=}")
+				if np.max(self.frame) == 0:
+					print("Looks like a frame was not successfully captured. Let's close and quit.")
+					self.close()
+					exit()
+			if frames > 1:
+				with phase(self.shot,'postprocess'):
+					accumulator.add(self.frame) # self.frame is overwritten by the next frame, but the accumulator keeps its own
+		timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+		if frames > 1:
+			if self.writer:
+				self.writer.submit(libstack.saveAverage,self.saveFrame,accumulator,light,wheel,exposure,timestamp,self.shot,shot=self.shot)
 			else:
-			 	if PxLApi.ReturnCode.ApiStreamStopped == ret[0]:
-			 		print("Stream is stopped")
-			 	elif PxLApi.ReturnCode.ApiNoCameraAvailableError == ret[0]:
-			 		print("No camera avilable")
-			 	elif PxLApi.ReturnCode.ApiBufferTooSmall == ret[0]:
-			 		print("Buffer too small")
-			 	else:
-			 		print(f"{ret=}")
-		if True:
-			print(f"{np.max(self.frame)=} {self.frame.shape=}")
-			if np.max(self.frame) == 0:
-				print("Looks like a frame was not successfully captured. Let's close and quit.")
-				self.close()
-				exit()
-		if True:
+				libstack.saveAverage(self.saveFrame,accumulator,light,wheel,exposure,timestamp,self.shot)
+			return
+		if self.writer:
+			self.writer.submit(self.saveFrame,self.frame.copy(),light,wheel,exposure,timestamp,self.shot,shot=self.shot) # copy because the next frame overwrites self.frame
+		else:
+			self.saveFrame(self.frame,light,wheel,exposure,timestamp,self.shot)
+
+	def saveFrame(self,img,light,wheel,exposure,timestamp,shot=None):
+		with phase(shot,'statistics'):
 			exposureGoal = 0.85*2**16 # might be 2**12 on pixelink
-			suggestion = exposureGoal*int(exposure)/np.percentile(self.frame,98)
-			saturatedpct = 100 * np.count_nonzero(self.frame > 64000) / np.count_nonzero(self.frame) # might be lower on pixelink
-			report = f"{light:-<10}{wheel:-<10}{exposure:->5}ms pixel values range {np.min(self.frame):>5} - {np.max(self.frame):5} with 98th percentile of {np.percentile(self.frame,98):>5.0f} and {saturatedpct:>3.1f}% of pixels above 64000, consider {suggestion:5.0f}"
+			stats = FrameStats(img)
+			suggestion = stats.suggestion(exposure,exposureGoal)
+			saturatedpct = stats.saturatedpct(64000) # might be lower on pixelink
+			report = f"{light:-<10}{wheel:-<10}{exposure:->5}ms pixel values range {stats.min:>5} - {stats.max:5} with 98th percentile of {stats.percentile(98):>5.0f} and {saturatedpct:>3.1f}% of pixels above 64000, consider {suggestion:5.0f}"
+		if True:
 			print(report)
 			self.reports.append(report)
 		directory = path.join(self.config['basepath'],self.target,'Raw')
 		if not path.exists(directory):
 			makedirs(directory)
-		timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 		fileExtension = 'tif'
 		if 'cool' in self.config:
 			gainDesc = 'gain'+str(self.config['gain'])+'_'+str(self.config['cool']).strip('-')
@@ -160,7 +186,11 @@ class Pixelink():
 			timestamp+'.'+fileExtension])
 		outfilePath = path.join(directory,outfileName)
 		print("Saving %s"%(outfilePath))
-		io.imsave(outfilePath,self.frame,check_contrast=False)
+		with phase(shot,'write'):
+			io.imsave(outfilePath,img,check_contrast=False)
+		if shot:
+			shot.saved(outfilePath)
+		return outfilePath
 
 	def close(self):
 		print("Closing Pixelink camera")
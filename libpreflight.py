@@ -0,0 +1,148 @@
+import shutil
+import yaml
+from os import path
+import libshotlist
+
+"""
+Checks a profile and shotlist before capture.py opens the camera, so a typo is found in seconds rather than after cooling or partway through a session
+Problems stop the session; warnings (an exposure the camera will round or cap) are only printed
+"""
+
+verbose = 3
+diskMargin = 1.1 # ask for this much more free space than the frames are expected to take
+strobeSensors = ('qhy','q15','simulat') # drivers that call onExposed when the sensor stops integrating
+
+def readLines(shotlistPath,problems):
+	if shotlistPath.lower().endswith('.yaml'):
+		with open(shotlistPath,'r') as unparsedyaml:
+			lines = yaml.load(unparsedyaml,Loader=yaml.SafeLoader)
+		if not isinstance(lines,list) or not all(isinstance(line,str) for line in lines):
+			problems.append("%s should be a YAML list of shots written like white6500-NoFilter-500ms"%(shotlistPath))
+			return []
+		return lines
+	with open(shotlistPath,'r') as unparsedtxt:
+		return unparsedtxt.readlines()
+
+def lightTable(lightsName):
+	"""
+	Class whose attributes name the lights it knows, or None when any light name is accepted
+	"""
+	import lights
+	lightsName = lightsName.lower()
+	if lightsName == 'octopusbluetooth':
+		return lights.OctopusBluetooth
+	if lightsName.startswith('octopus'):
+		return lights.Octopus
+	return None
+
+def checkLight(light,lightsName,problems,warnings):
+	table = lightTable(lightsName)
+	if table:
+		names = light.split('+') if table.__name__ == 'Octopus' else [light] # only the USB Octopus turns on several lights at once
+		for name in names:
+			if not isinstance(getattr(table,name,None),tuple):
+				problems.append("%s lights do not have a light named %s"%(lightsName,name))
+	elif lightsName.lower().startswith('misha'):
+		import lights
+		if light not in lights.Misha.wavelengths:
+			warnings.append("Misha light panels may not understand light %s"%(light))
+
+def checkWheel(wheel,sensor,problems):
+	if not sensor.lower().startswith(('qhy','q15')):
+		return # other cameras record the filter in the filename but do not move it
+	from libqhy import Filters
+	if not isinstance(getattr(Filters,wheel,None),int):
+		problems.append("The filter wheel does not have a filter named %s"%(wheel))
+
+def checkExposure(exposure,sensor,warnings):
+	sensor = sensor.lower()
+	if sensor.startswith(('canon','spencer')):
+		try:
+			from libcanon import Canon
+		except ImportError:
+			return # no Canon SDK on this computer, as in a dry run elsewhere
+		if exposure not in Canon.milliseconds:
+			rounded = min(Canon.milliseconds.keys(),key=lambda k: abs(k-exposure))
+			warnings.append("Canon will round %sms to %sms"%(exposure,rounded))
+	elif sensor.startswith('flir'):
+		try:
+			from libflir import maxExposure
+		except ImportError:
+			return
+		if exposure > maxExposure:
+			warnings.append("Flir will cap %sms at %sms"%(exposure,maxExposure))
+
+def checkFrames(exposure,sensor,problems):
+	if libshotlist.frames(exposure) > 1 and sensor.lower().startswith(('canon','spencer','kolarielph')):
+		problems.append("%s cannot average frames, remove -x%s"%(sensor,libshotlist.frames(exposure)))
+
+def checkStrobe(sensor,problems):
+	if not sensor.lower().startswith(strobeSensors):
+		problems.append("%s does not report when an exposure ends, so --strobe would turn the light off during the exposure"%(sensor))
+
+def shotBytes(exposure,sensor):
+	if libshotlist.frames(exposure) > 1:
+		return 3*frameBytes(sensor) # the average and a 32 bit noise map
+	return frameBytes(sensor)
+
+def frameBytes(sensor):
+	from libsim import models
+	w,h,bpp,readout,opening = models['qhy600']
+	for name in models:
+		if sensor.lower().startswith(name):
+			w,h,bpp,readout,opening = models[name]
+	if sensor.lower().startswith(('canon','spencer')):
+		return w*h*2 + 3*(w//2)*(h//2)*2 # the raw frame and a half size TIFF for each of red, green, and blue
+	return w*h*2 # saved as 16 bit TIFF
+
+def checkDisk(basepath,bytesNeeded,problems):
+	directory = path.expanduser(basepath)
+	while not path.exists(directory) and path.dirname(directory) != directory:
+		directory = path.dirname(directory)
+	free = shutil.disk_usage(directory).free
+	if free < diskMargin*bytesNeeded:
+		problems.append("%s has %.1f GB free but the session needs about %.1f GB"%(directory,free/1e9,bytesNeeded/1e9))
+
+def check(config,shotlistPath,targets=1,disk=True,strobe=False):
+	"""
+	Returns True if the session can go ahead
+	"""
+	problems = []
+	warnings = []
+	for key in ('sensor','lens','lights','aperture','gain','basepath'):
+		if key not in config:
+			problems.append("The profile does not have %s"%(key))
+	if problems:
+		for problem in problems:
+			print("Preflight problem: %s"%(problem))
+		return False
+	sensor = str(config['sensor'])
+	if strobe:
+		checkStrobe(sensor,problems)
+	if sensor.lower().startswith('simulat'):
+		sensor = str(config.get('model',sensor))
+	shots = []
+	for number, line in enumerate(readLines(shotlistPath,problems)):
+		try:
+			shot = libshotlist.parseShot(line)
+		except ValueError:
+			problems.append("Line %s of %s is not light-filter-exposure: %s"%(number+1,shotlistPath,line.strip()))
+			continue
+		if shot:
+			shots.append(shot)
+	for light,wheel,exposure in shots:
+		checkLight(light,str(config['lights']),problems,warnings)
+		checkWheel(wheel,sensor,problems)
+		checkExposure(exposure,sensor,warnings)
+		checkFrames(exposure,sensor,problems)
+	if len(shots) == 0 and not problems:
+		problems.append("%s has no shots"%(shotlistPath))
+	if disk:
+		checkDisk(config['basepath'],targets*sum(shotBytes(exposure,sensor) for light,wheel,exposure in shots),problems)
+	for warning in sorted(set(warnings)):
+		print("Preflight warning: %s"%(warning))
+	for problem in sorted(set(problems),key=problems.index):
+		print("Preflight problem: %s"%(problem))
+	if not problems:
+		print("Preflight found %s shots ready for %s"%(len(shots),sensor)) if verbose > 2 else None
+	return len(problems) == 0
@@ -2,9 +2,16 @@ import ctypes
 from ctypes import *
 import numpy as np
 import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from os import makedirs, path
 from skimage import io
 from datetime import datetime
+from libtiming import phase
+from libstats import FrameStats
+from libwheel import WheelModel
+from libtelemetry import Telemetry
+import libstack
 
 variant = 'megavision'
 variant = 'trh'
@@ -13,6 +20,12 @@ reportheader = '___MS__|_MAYBE_|_98THP_|__SAT__|__MIN__|__MAX__|______LIGHT_____
 
 verbose = 3
 linearityHDR = False
+ringSize = 3 # frame buffers, enough for one exposing, one waiting to be saved, and one saving
+exposurePoll = 0.05 # seconds between checks of IS_EXPOSING_DONE
+exposureTimeout = 10 # seconds past the requested exposure to wait for IS_EXPOSING_DONE before reading out anyway
+wheelPoll = 0.05 # seconds between checks of the wheel position
+wheelTimeout = 15 # seconds to wait for the wheel to report the new position
+coolTimeout = 900 # seconds to wait for the sensor temperature to settle, override with cooltimeout in the profile
 if variant == 'megavision':
 	exposureGoal = 0.85*38600
 	warnsaturation = 37700
@@ -36,9 +49,41 @@ class Filters:
 		WrattenInfrared87C = 6
 		Position1 = 1
 
+class FrameRing():
+	"""
+	Preallocated buffers, each large enough for a full frame, so that no exposure writes into a frame still being saved or shown
+	acquire() hands out a free buffer, view() shapes it as a numpy array without copying, and release() gives it back
+	"""
+	def __init__(self,length,count=ringSize):
+		self.length = length
+		self.buffers = [(ctypes.c_uint8 * length)() for i in range(count)]
+		self.free = queue.Queue()
+		for buffer in self.buffers:
+			self.free.put(buffer)
+		self.lent = {}
+		print("Allocated %s frame buffers of %s bytes"%(count,length)) if verbose > 3 else None
+
+	def acquire(self):
+		if self.free.empty():
+			print("Waiting for a frame buffer to be released") if verbose > 2 else None
+		return self.free.get()
+
+	def view(self,buffer,w,h,bpp):
+		dtype = np.uint16 if bpp == 16 else np.uint8
+		frame = np.frombuffer(buffer,dtype=dtype,count=w*h).reshape(h,w)
+		self.lent[frame.__array_interface__['data'][0]] = buffer
+		return frame
+
+	def release(self,frame):
+		buffer = self.lent.pop(frame.__array_interface__['data'][0],None)
+		if buffer is not None:
+			self.free.put(buffer)
+
 class Qhyccd():
 	def __init__(self):
 		self.reports = []
+		self.writer = None # capture.py attaches a FrameWriter for pipelined sessions
+		self.shot = None # capture.py attaches a ShotTiming for each shot
 		self.x = c_uint()
 		self.y = c_uint()
 		self.w = c_uint()
@@ -56,6 +101,15 @@ class Qhyccd():
 		self.sdk= CDLL('/usr/local/lib/libqhyccd.so')
 		self.sdk.GetQHYCCDParam.restype = c_double
 		self.sdk.OpenQHYCCD.restype = ctypes.POINTER(c_uint32)
+		self.sdk.GetQHYCCDMemLength.restype = c_uint32
+		self.ring = None
+		self.liveFrame = None
+		self.executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix='QHYExposure') # one exposure at a time
+		self.onExposed = None # optional function called as soon as an exposure ends, before readout
+		self.exposureGoal = exposureGoal
+		self.warnsaturation = warnsaturation
+		self.testBinning = 1
+		self.telemetry = None
 		# ref: https://www.qhyccd.com/bbs/index.php?topic=6356.0
 
 	def session(self,config,target): 
@@ -90,9 +144,23 @@ class Qhyccd():
 		self.sdk.SetQHYCCDParam(self.cam, CONTROL_ID.CONTROL_MANULPWM, c_double(255)) # Maximum fan speed seems to be not working but fan is certainly running even with reported value 0
 		print("Setting cooling to %s"%(self.config['cool'])) 
 		self.SetCooler(self.config['cool'])
-		while self.CheckTemp() > 0.98*self.config['cool']:
-			print("Waiting for current temp %s to reach target temp %s"%(self.CheckTemp(),self.config['cool']))
-			time.sleep(3)
+		if self.telemetry is None:
+			self.hasHumidity = self.sdk.IsQHYCCDControlAvailable(self.cam,CONTROL_ID.CAM_HUMIDITY) >= 0
+			self.telemetry = Telemetry(self.readTelemetry)
+			self.telemetry.start() # capture.py sets up the lights while the sensor cools, then calls waitCooled()
+
+	def readTelemetry(self):
+		reading = {
+			'temperature':round(self.CheckTemp(),2),
+			'power':round(100*self.sdk.GetQHYCCDParam(self.cam,CONTROL_ID.CONTROL_CURPWM)/255,1)
+		}
+		if self.hasHumidity:
+			reading['humidity'] = round(self.sdk.GetQHYCCDParam(self.cam,CONTROL_ID.CAM_HUMIDITY),1)
+		return reading
+
+	def waitCooled(self):
+		if self.telemetry:
+			self.telemetry.waitStable(self.config['cool'],self.config.get('cooltimeout',coolTimeout))
 
 	def connect(self, mode):
 		self.mode = mode # 1 is stream, 0 is single frame
@@ -106,9 +174,13 @@ class Qhyccd():
 		self.cam = self.sdk.OpenQHYCCD(self.id)
 		self.sdk.SetQHYCCDStreamMode(self.cam, self.mode)  
 		self.sdk.InitQHYCCD(self.cam)
+		if getattr(self,'wheelModel',None) is None: # a reconnect keeps the moves timed so far
+			self.wheelModel = WheelModel(self.id.value.decode())
 		# Get Camera Parameters
 		self.sdk.GetQHYCCDChipInfo(self.cam,byref(self.chipw),byref(self.chiph),byref(self.w),byref(self.h),byref(self.pixelw),byref(self.pixelh),byref(self.bpp))
-		self.imgdata = (ctypes.c_uint8 * self.w.value* self.h.value)()
+		memLength = self.sdk.GetQHYCCDMemLength(self.cam)
+		if self.ring is None or self.ring.length != memLength: # reconnecting to change stream mode keeps the ring and any frames still out
+			self.ring = FrameRing(memLength,self.config.get('buffers',ringSize) if hasattr(self,'config') else ringSize)
 
 	def SetBinMode(self,binX,binY):
 		self.sdk.SetQHYCCDBinMode(self.cam,binX,binY) # necessary to set bin mode before query effective area
@@ -123,15 +195,12 @@ class Qhyccd():
 	""" Set camera ROI """
 	def SetROI(self, newX, newY, newW, newH):
 		print("Setting ROI to x,y,w,h = %s,%s,%s,%s"%(newX,newY,newW,newH))
+		if newW * newH * self.bpp.value//8 > self.ring.length: # buffers are sized for a full frame so changing ROI needs no new allocation
+			raise RuntimeError("ROI of %s × %s at %s bits does not fit in frame buffers of %s bytes"%(newW,newH,self.bpp.value,self.ring.length))
 		self.roi_x = c_uint(newX) # likely need to take into account that effective image area does not start at x = 0
 		self.roi_y = c_uint(newY)
 		self.roi_w = c_uint(newW)
 		self.roi_h = c_uint(newH)
-		# update buffer to recive camera image
-		if self.bpp.value == 16:
-			self.imgdata = (ctypes.c_uint16 * newW * newH)()
-		else: 
-			self.imgdata = (ctypes.c_uint8 * newW * newH)()
 		self.sdk.SetQHYCCDResolution(self.cam,newX,newY,newW,newH)
 
 	def SetStreamMode(self, mode):
@@ -167,31 +236,102 @@ class Qhyccd():
 		self.bpp.value = bpp
 		self.sdk.SetQHYCCDParam(self.cam, CONTROL_ID.CONTROL_TRANSFERBIT, c_double(bpp))
 
-	""" Exposure and return single frame """
+	""" Exposure and return single frame, which belongs to the caller until passed to self.ring.release() """
 	def GetSingleFrame(self):
-		ret = self.sdk.ExpQHYCCDSingleFrame(self.cam)
-		ret = self.sdk.GetQHYCCDSingleFrame(
-			self.cam, byref(self.roi_w), byref(self.roi_h), byref(self.bpp),
-			byref(self.channels), self.imgdata)
-		return np.asarray(self.imgdata) #.reshape([self.roi_h.value, self.roi_w.value])
+		return self.startExposure().result()
+
+	def startExposure(self):
+		"""
+		Begin an exposure in the background and return a future for the frame
+		self.onExposed is called when the sensor stops integrating, before readout, so other work can go on meanwhile
+		shootAverage() starts the next exposure while the previous frame is added to the average
+		"""
+		return self.executor.submit(self.exposeAndRead)
+
+	def exposeAndRead(self):
+		buffer = self.ring.acquire()
+		try:
+			with phase(self.shot,'exposure'):
+				exposureStart = time.monotonic()
+				ret = self.sdk.ExpQHYCCDSingleFrame(self.cam)
+				self.waitExposingDone(exposureStart)
+			if self.shot and self.telemetry:
+				self.shot.record['telemetry'] = self.telemetry.latest() # sensor temperature as the exposure ended
+			if self.onExposed:
+				self.onExposed()
+			with phase(self.shot,'readout'):
+				ret = self.sdk.GetQHYCCDSingleFrame(
+					self.cam, byref(self.roi_w), byref(self.roi_h), byref(self.bpp),
+					byref(self.channels), buffer)
+		except Exception:
+			self.ring.free.put(buffer)
+			raise
+		return self.ring.view(buffer,self.roi_w.value,self.roi_h.value,self.bpp.value)
+
+	def waitExposingDone(self,exposureStart):
+		"""
+		Some models return from ExpQHYCCDSingleFrame while still exposing, so poll IS_EXPOSING_DONE where the camera has it
+		Without it, wait until the exposure time has passed since exposureStart
+		"""
+		if self.sdk.IsQHYCCDControlAvailable(self.cam,CONTROL_ID.IS_EXPOSING_DONE) < 0:
+			remaining = exposureStart + self.exposureMS/1000 - time.monotonic()
+			if remaining > 0:
+				time.sleep(remaining)
+			return
+		deadline = time.monotonic() + self.exposureMS/1000 + exposureTimeout
+		while self.sdk.GetQHYCCDParam(self.cam,CONTROL_ID.IS_EXPOSING_DONE) == 0:
+			if time.monotonic() > deadline:
+				print("Camera did not report the exposure done, reading out anyway")
+				break
+			time.sleep(exposurePoll)
  
+	def beginTestFrames(self,binXY):
+		""" Binned frames for auto exposure, the same way liveview.py bins """
+		self.testBinning = binXY
+		self.SetBinMode(binXY,binXY)
+		self.SetROI(self.x.value, self.y.value, self.w.value, self.h.value)
+
+	def testFrame(self,exposureMS):
+		""" Binning sums pixels, so a fraction of the exposure gives the levels of a full resolution frame """
+		shot, self.shot = self.shot, None # test frames are timed as a whole by the caller
+		try:
+			self.SetExposure(max(1,int(exposureMS/self.testBinning**2)))
+			img = self.GetSingleFrame()
+			test = img.copy()
+			self.ring.release(img)
+		finally:
+			self.shot = shot
+		return test
+
+	def endTestFrames(self):
+		self.testBinning = 1
+		self.SetBinMode(1,1)
+		self.SetROI(self.x.value, self.y.value, self.w.value, self.h.value)
+
 	def BeginLive(self):
 		""" Begin live mode"""
 		#self.sdk.SetQHYCCDStreamMode(self.cam, 1)  # Live mode
 		self.sdk.BeginQHYCCDLive(self.cam)
 	
 	def GetLiveFrame(self):
-		""" Return live image """
-		self.sdk.GetQHYCCDLiveFrame(self.cam, byref(self.roi_h), byref(self.roi_w), 
-			byref(self.bpp), byref(self.channels), self.imgdata)
+		""" Return live image, valid until the next call """
+		if self.liveFrame is not None:
+			self.ring.release(self.liveFrame)
+		buffer = self.ring.acquire()
+		self.sdk.GetQHYCCDLiveFrame(self.cam, byref(self.roi_w), byref(self.roi_h), 
+			byref(self.bpp), byref(self.channels), buffer)
+		self.liveFrame = self.ring.view(buffer,self.roi_w.value,self.roi_h.value,self.bpp.value)
 		if variant == 'megavision':
-			print(f"LIBQHY: Sending live frame with max value {np.max(self.imgdata)}")
+			print(f"LIBQHY: Sending live frame with max value {np.max(self.liveFrame)}")
 			time.sleep(1)
-		return np.asarray(self.imgdata)
+		return self.liveFrame
 
 	def StopLive(self):
 		""" Stop live mode, change to single frame """
 		self.sdk.StopQHYCCDLive(self.cam)
+		if self.liveFrame is not None:
+			self.ring.release(self.liveFrame)
+			self.liveFrame = None
 		#self.sdk.SetQHYCCDStreamMode(self.cam, 0)  # Single Mode
 
 	""" Relase camera and close sdk """
@@ -200,6 +340,10 @@ class Qhyccd():
 		for report in self.reports:
 			print(report)
 		print("Closing %s"%(bytes(self.id).decode()))
+		self.wheelModel.save()
+		self.executor.shutdown()
+		if self.telemetry:
+			self.telemetry.stop()
 		self.sdk.CloseQHYCCD(self.cam)
 		self.sdk.ReleaseQHYCCDResource()
 
@@ -310,26 +454,52 @@ class Qhyccd():
 		wheelNewPosition = int(wheelNewPosition + 47) # offset by 47 when using parameters
 		wheelCurrentPosition = self.sdk.GetQHYCCDParam(self.cam,CONTROL_ID.CONTROL_CFWPORT)
 		print("Wheel presently at position %s of %s"%(int(wheelCurrentPosition-47),int(wheelNumSlots))) if verbose > 3 else None
+		if wheelCurrentPosition == wheelNewPosition:
+			return
+		fromSlot = int(wheelCurrentPosition-47)
+		toSlot = int(wheelNewPosition-47)
+		start = time.monotonic()
 		self.sdk.SetQHYCCDParam(self.cam,CONTROL_ID.CONTROL_CFWPORT,c_double(wheelNewPosition))
-		if wheelNewPosition == 48 and wheelCurrentPosition != 48:
-			print("Waiting 5 seconds for wheel to move to first position (fixed value because wheel reports first position while operation is in progress)")
-			time.sleep(5)
+		if wheelNewPosition == 48:
+			seconds = self.wheelModel.wait(fromSlot,toSlot,5) # the position cannot be checked, so 5 seconds until the wheel has been timed
+			print("Waiting %.1f seconds for wheel to move to first position (wheel reports first position while operation is in progress)"%(seconds))
+			time.sleep(seconds)
 			wheelCurrentPosition = self.sdk.GetQHYCCDParam(self.cam,CONTROL_ID.CONTROL_CFWPORT)
 		elif bytes(self.id).decode().startswith('QHYminiCam'):
-			if wheelCurrentPosition != wheelNewPosition:
-				print("Waiting 8 seconds for miniCam wheel to move")
-				time.sleep(8)
-			wheelCurrentPosition = wheelNewPosition
-		elif bytes(self.id).decode().startswith('QHYminiCam'):
-			print("Restore the pause when put filters in minicam")
+			seconds = self.wheelModel.wait(fromSlot,toSlot,8)
+			print("Waiting %.1f seconds for miniCam wheel to move"%(seconds))
+			time.sleep(seconds)
 			wheelCurrentPosition = wheelNewPosition
 		else:
-			while wheelCurrentPosition != wheelNewPosition:
-				print("Waiting for wheel to move from position %s to position %s"%(int(wheelCurrentPosition-47),int(wheelNewPosition-47)))
-				time.sleep(1)
+			print("Waiting for wheel to move from position %s to position %s"%(fromSlot,toSlot))
+			while wheelCurrentPosition != wheelNewPosition and time.monotonic() - start < wheelTimeout:
+				time.sleep(wheelPoll)
 				wheelCurrentPosition = self.sdk.GetQHYCCDParam(self.cam,CONTROL_ID.CONTROL_CFWPORT)
+			if wheelCurrentPosition == wheelNewPosition:
+				self.wheelModel.observe(fromSlot,toSlot,time.monotonic()-start)
+			else:
+				raise RuntimeError("Wheel did not report position %s within %s seconds, so it may still be moving"%(toSlot,wheelTimeout)) # capture.py reopens the camera and tries again
 		print("Wheel presently at position %s of %s"%(int(wheelCurrentPosition-47),int(wheelNumSlots))) if verbose > 3 else None
 
+	def calibrateWheel(self):
+		"""
+		Times every move the wheel reports, so that moves to the first position can be estimated and later sessions know what to expect
+		"""
+		if bytes(self.id).decode().startswith('QHYminiCam'):
+			print("The miniCam wheel does not report its position, so it cannot be calibrated")
+			return
+		wheelNumSlots = int(self.sdk.GetQHYCCDParam(self.cam,CONTROL_ID.CONTROL_CFWSLOTSNUM))
+		for fromSlot in range(2,wheelNumSlots+1):
+			for toSlot in range(2,wheelNumSlots+1):
+				if toSlot != fromSlot:
+					self.setWheel(fromSlot)
+					self.setWheel(toSlot)
+					print("Wheel moved from %s to %s in %s seconds"%(fromSlot,toSlot,self.wheelModel.moves.get(fromSlot,{}).get(toSlot)))
+		for fromSlot in range(2,wheelNumSlots+1): # moves from the first position report normally
+			self.setWheel(1)
+			self.setWheel(fromSlot)
+		self.wheelModel.save()
+
 	def showInfo(self):
 		print("Camera %s properties"%(bytes(self.id).decode()))
 		print("\tchip width = %s"%(self.chipw.value))
@@ -343,25 +513,58 @@ class Qhyccd():
 		self.GetExtraInfo()
 		self.CheckAllParameters()
 
-	def shoot(self,light,wheel,exposure):
+	def shoot(self,light,wheel,exposure,frames=1):
 		self.SetExposure(int(exposure)) 
-		img = self.GetSingleFrame()
+		if frames > 1:
+			self.shootAverage(light,wheel,exposure,frames)
+			return
+		img = self.startExposure().result()
+		timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+		if self.writer:
+			self.writer.submit(self.saveAndRelease,img,light,wheel,exposure,timestamp,self.shot,shot=self.shot) # no copy, the next exposure gets another buffer from the ring
+		else:
+			self.saveAndRelease(img,light,wheel,exposure,timestamp,self.shot)
+
+	def shootAverage(self,light,wheel,exposure,frames):
+		""" Frames back to back, each added to the average while the next exposes """
+		accumulator = libstack.Accumulator()
+		future = self.startExposure()
+		for frame in range(frames):
+			img = future.result()
+			if frame < frames-1:
+				future = self.startExposure()
+			try:
+				with phase(self.shot,'postprocess'):
+					accumulator.add(img)
+			finally:
+				self.ring.release(img)
+		timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+		if self.writer:
+			self.writer.submit(libstack.saveAverage,self.saveFrame,accumulator,light,wheel,exposure,timestamp,self.shot,shot=self.shot)
+		else:
+			libstack.saveAverage(self.saveFrame,accumulator,light,wheel,exposure,timestamp,self.shot)
+
+	def saveAndRelease(self,img,*args):
+		try:
+			self.saveFrame(img,*args)
+		finally:
+			self.ring.release(img)
+
+	def saveFrame(self,img,light,wheel,exposure,timestamp,shot=None):
 		if False:
 			print("Image has shape and type %s %s"%(img.shape,img.dtype))
 			print("Numpy object has shape %s, dtype %s, range %s - %s, median %s with standard deviation %s"%(img.shape,img.dtype,np.min(img),np.max(img),np.median(img),np.std(img)))
 		if False:
 			report = f"{light:-<10}{wheel:-<11}{exposure:->5}ms pixel values range {np.min(img):>5} - {np.max(img):5} with 98th percentile of {np.percentile(img,98):>5.0f} and {saturatedpct:>3.1f}% of pixels above {warnsaturation}, consider {suggestion:5.0f}"
+		with phase(shot,'statistics'):
+			report = FrameStats(img).report(exposure,light,wheel,exposureGoal,warnsaturation)
 		if True:
-			suggestion = exposureGoal*int(exposure)/np.percentile(img,98)
-			saturatedpct = 100 * np.count_nonzero(img > warnsaturation) / np.count_nonzero(img)
-			report = f"{exposure:_>6}_|{suggestion:_>6.0f}_|{np.percentile(img,98):_>6.0f}_|{saturatedpct:_>5.1f}%_|{np.min(img):_>6}_|{np.max(img):_>6}_|{light:_^17}|{wheel:_^17}" 
 			print(reportheader)
 			print(report)
 			self.reports.append(report)
 		directory = path.join(self.config['basepath'],self.target,'Raw')
 		if not path.exists(directory):
 			makedirs(directory)
-		timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 		fileExtension = 'tif'
 		if self.config['cool']:
 			gainDesc = 'gain'+str(self.config['gain'])+'_'+str(self.config['cool']).strip('-')
@@ -379,7 +582,11 @@ class Qhyccd():
 			timestamp+'.'+fileExtension])
 		outfilePath = path.join(directory,outfileName)
 		print("Saving %s"%(outfilePath))
-		io.imsave(outfilePath,img,check_contrast=False)
+		with phase(shot,'write'):
+			io.imsave(outfilePath,img,check_contrast=False)
+		if shot:
+			shot.saved(outfilePath)
+		return outfilePath
 
 """
 @brief CONTROL_ID enum define
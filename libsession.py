@@ -0,0 +1,136 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import lights
+import libshotlist
+from libtiming import phase
+
+"""
+Runs a shotlist with asyncio so that independent hardware can work at the same time
+Each device gets its own single thread executor, which keeps its calls in order while different devices overlap
+Each shot is a small graph:
+	the wheel moves once the previous frame is read out, while the previous light goes off, the next light comes on, and the lights settle
+	the exposure begins once both the wheel and the lights are ready
+	the light goes off once the frame is read out, or with --strobe once the exposure ends, while the next wheel move begins
+	when the next shot uses the same light it stays on, so there is nothing to switch or settle
+With capture.py -p the previous frame is written in the background as well
+In a dry run each call carries the virtual time it depends on, since the simulated clock cannot see what the event loop waits for
+"""
+
+verbose = 3
+
+class SessionController():
+	def __init__(self,camera,lightArray,sleep=time.sleep,dryRun=False,autoExposure=None,strobe=False,clock=None):
+		self.camera = camera
+		self.clock = clock if clock and clock.virtual else None
+		self.autoExposure = autoExposure
+		self.strobe = lights.Strobe(lightArray,camera) if strobe else None
+		self.lightArray = lightArray
+		self.sleep = sleep
+		self.dryRun = dryRun
+		self.executors = {}
+		for device in ('camera','wheel','lights'):
+			self.executors[device] = ThreadPoolExecutor(max_workers=1,thread_name_prefix=device)
+
+	async def call(self,device,function,*args,shot=None,name=None,after=0):
+		"""
+		Returns the result and the virtual time the call finished, which is 0 outside a dry run
+		"""
+		def timed():
+			if self.clock:
+				self.clock.wait(after)
+			with phase(shot,name):
+				result = function(*args)
+			return result, self.clock.now() if self.clock else 0
+		return await asyncio.get_running_loop().run_in_executor(self.executors[device],timed)
+
+	async def lightOn(self,lightOff,shot,light):
+		after = 0
+		if lightOff:
+			after = await lightOff # only one light at a time
+		result, after = await self.call('lights',self.lightArray.manualon,light,shot=shot,name='lighton',after=after)
+		seconds, after = await self.call('lights',lights.waitReady,self.lightArray,light,self.sleep,shot=shot,name='settle',after=after)
+		if self.dryRun:
+			shot.add('settle',seconds) # the virtual clock does not take any time
+		return after
+
+	async def lightOff(self,shot,strobe,after):
+		try:
+			if strobe:
+				result, after = await self.call('lights',self.strobe.finish,after=after)
+			else:
+				result, after = await self.call('lights',self.lightArray.off,shot=shot,name='lightoff',after=after)
+		finally:
+			if shot:
+				shot.release()
+		return after
+
+	async def run(self,shotlist,timing):
+		lightOff = None
+		lit = None # light left on because the next shot uses it too
+		readOut = 0 # virtual time the previous frame was read out
+		try:
+			timing.rewind()
+			for index, (light,wheel,exposure) in enumerate(shotlist):
+				shot = timing.begin(light,wheel,exposure)
+				if shot.done:
+					print("Already have Light = %s | Wheel = %s | Exposure = %s"%(light,wheel,exposure))
+					continue
+				frames = libshotlist.frames(exposure)
+				print("\aShooting Light = %s | Wheel = %s | Exposure = %s%s"%(light,wheel,exposure,' | Frames = %s'%(frames) if frames > 1 else ''))
+				self.camera.shot = shot
+				if lit and lit != light:
+					lightOff = asyncio.create_task(self.lightOff(None,False,readOut))
+				lighting = None
+				if lit != light:
+					lighting = asyncio.create_task(self.lightOn(lightOff,shot,light))
+				lit = None
+				strobe = False
+				try:
+					if lighting:
+						(result, wheelReady), lightReady = await asyncio.gather(
+							self.call('wheel',self.camera.setWheel,wheel,shot=shot,name='wheel',after=readOut),
+							lighting)
+					else:
+						result, wheelReady = await self.call('wheel',self.camera.setWheel,wheel,shot=shot,name='wheel',after=readOut)
+						lightReady = 0 # still on from the previous shot
+					ready = max(wheelReady,lightReady)
+					if self.autoExposure:
+						exposure, ready = await self.call('camera',self.autoExposure.converge,light,wheel,exposure,after=ready)
+					strobe = self.strobe and frames == 1 # the light stays on for every frame of an average
+					if strobe:
+						self.strobe.arm(exposure,shot)
+					if frames > 1:
+						shot.record['frames'] = frames
+						result, readOut = await self.call('camera',self.camera.shoot,light,wheel,exposure,frames,after=ready)
+					else:
+						result, readOut = await self.call('camera',self.camera.shoot,light,wheel,exposure,after=ready) # the driver times its own phases
+				except BaseException:
+					if lighting:
+						await asyncio.gather(lighting,return_exceptions=True) # the light may still be coming on when the wheel fails
+					lightOff = asyncio.create_task(self.lightOff(shot,strobe,readOut))
+					raise
+				if not strobe and index+1 < len(shotlist) and shotlist[index+1][0] == light:
+					lit = light
+					shot.release()
+				else:
+					lightOff = asyncio.create_task(self.lightOff(shot,strobe,readOut))
+		finally:
+			if lightOff:
+				await lightOff
+			if lit:
+				await self.call('lights',self.lightArray.off)
+			self.camera.shot = None
+
+	def runShotlist(self,shotlist,timing):
+		print("Starting shot list for %s with overlapping camera, wheel, and lights"%(self.camera.target))
+		try:
+			asyncio.run(self.run(shotlist,timing))
+		finally:
+			for executor in self.executors.values():
+				executor.shutdown()
+			if self.clock:
+				self.clock.wait(self.clock.slept) # whatever comes next begins once every device has finished
+
+if __name__ == "__main__":
+	print("This is not meant to be run but called from capture.py")
@@ -0,0 +1,170 @@
+import itertools
+import yaml
+from libwheel import WheelModel
+
+"""
+Reading shotlists and optionally reordering them to spend less time moving the filter wheel and switching lights
+A shot is a tuple of (light, wheel, exposure in milliseconds); filenames are built from those fields, so reordering does not change them
+A line can end in -xN to average N frames, as in uv385-NoFilter-12000ms-x8, and the exposure then carries frames
+"""
+
+verbose = 3
+wheelSlots = 7 # positions 1-7
+wheelSecondsPerSlot = 1.0 # used until the wheel has been timed, see libwheel
+wheelSecondsToFirst = 5 # libqhy waits 5 seconds for moves to slot 1 until the wheel has been timed
+wheelSecondsMini = 8 # libqhy waits 8 seconds for miniCam moves, whose wheel cannot be timed
+lightSwitchSeconds = 0.5
+maxExhaustiveGroups = 7 # one group per wheel slot, 7! orders is quick to search
+
+class Exposure(int):
+	"""
+	Milliseconds that also carry how many frames to average
+	Compares and prints as plain milliseconds, so filenames, scheduling, and the journal treat it as any other exposure
+	"""
+	def __new__(cls,milliseconds,frames=1):
+		exposure = super().__new__(cls,milliseconds)
+		exposure.frames = frames
+		return exposure
+
+def frames(exposure):
+	return getattr(exposure,'frames',1)
+
+def parseShot(shot):
+	"""
+	Returns (light, wheel, exposure) or None for blank lines, comments, and log lines
+	"""
+	shot = shot.strip()
+	if shot == "" or shot.startswith('log:') or shot.startswith('#'):
+		return None
+	fields = shot.split(sep='-')
+	if len(fields) == 4 and fields[3].startswith('x'):
+		light,wheel,exposure,count = fields
+		count = int(count[1:])
+		if count < 1:
+			raise ValueError("Frames to average must be at least 1")
+		return (light,wheel,Exposure(int(exposure.strip('ms')),count))
+	light,wheel,exposure = fields
+	exposure = int(exposure.strip('ms'))
+	return (light,wheel,exposure)
+
+def formatShot(light,wheel,exposure):
+	if frames(exposure) > 1:
+		return "%s-%s-%sms-x%s"%(light,wheel,exposure,frames(exposure))
+	return "%s-%s-%sms"%(light,wheel,exposure)
+
+def readShotlist(shotlistpath):
+	if shotlistpath.lower().endswith('.yaml'): # makes sense to use yaml for config and txt for shotlist
+		with open(shotlistpath,'r') as unparsedyaml:
+			lines = yaml.load(unparsedyaml,Loader=yaml.SafeLoader)
+	else:
+		with open(shotlistpath,'r') as unparsedtxt:
+			lines = unparsedtxt.readlines()
+	shots = []
+	for line in lines:
+		shot = parseShot(line)
+		if shot:
+			shots.append(shot)
+	return shots
+
+def wheelSlot(wheel):
+	from libqhy import Filters
+	slot = getattr(Filters,wheel,wheel)
+	try:
+		return int(slot)
+	except ValueError:
+		return None
+
+wheelModels = {}
+
+def wheelModel(sensor):
+	if sensor not in wheelModels:
+		wheelModels[sensor] = WheelModel.forSensor(sensor)
+	return wheelModels[sensor]
+
+def wheelSeconds(sensor,fromWheel,toWheel):
+	"""
+	Cost model that mirrors the waits in libqhy.Qhyccd.setWheel, using timed moves when the wheel has been calibrated; cameras without a software controlled wheel cost nothing
+	"""
+	if fromWheel == toWheel or not sensor.lower().startswith(('qhy','q15')):
+		return 0
+	fromSlot = wheelSlot(fromWheel)
+	toSlot = wheelSlot(toWheel)
+	if fromSlot == toSlot or fromSlot is None or toSlot is None:
+		return 0
+	model = wheelModel(sensor)
+	if toSlot == 1 or sensor.lower().startswith('qhymini'):
+		fixed = wheelSecondsToFirst if toSlot == 1 else wheelSecondsMini
+		return model.wait(fromSlot,toSlot,fixed) if model else fixed
+	if model and model.seconds(fromSlot,toSlot) is not None:
+		return model.seconds(fromSlot,toSlot)
+	distance = abs(toSlot - fromSlot)
+	distance = min(distance,wheelSlots-distance) # wheel can turn either way
+	return distance*wheelSecondsPerSlot
+
+def sequenceSeconds(shots,sensor,startWheel=None,startLight=None,switchSeconds=lightSwitchSeconds):
+	seconds = 0
+	wheel = startWheel
+	light = startLight
+	for shotLight,shotWheel,exposure in shots:
+		if wheel is not None:
+			seconds += wheelSeconds(sensor,wheel,shotWheel)
+		if light is not None and shotLight != light:
+			seconds += switchSeconds
+		wheel = shotWheel
+		light = shotLight
+	return seconds
+
+def orderByLight(shots,previousLight):
+	"""
+	Keeps shots with the same light together, starting with the light already on if there is one
+	"""
+	lights = []
+	for light,wheel,exposure in shots:
+		if light not in lights:
+			lights.append(light)
+	if previousLight in lights:
+		lights.remove(previousLight)
+		lights.insert(0,previousLight)
+	return [shot for light in lights for shot in shots if shot[0] == light]
+
+def schedule(shots,sensor,startWheel=None,switchSeconds=lightSwitchSeconds):
+	"""
+	Chooses the cheapest order of filter groups, exhaustively when there are few groups and nearest first otherwise
+	Returns the reordered shots along with the predicted seconds for the original and the new order
+	"""
+	if len(shots) == 0:
+		return shots,0,0
+	if startWheel is None:
+		startWheel = shots[0][1]
+	groups = {}
+	for shot in shots:
+		groups.setdefault(shot[1],[]).append(shot)
+	def build(wheelOrder):
+		ordered = []
+		for wheel in wheelOrder:
+			previousLight = ordered[-1][0] if ordered else None
+			ordered += orderByLight(groups[wheel],previousLight)
+		return ordered
+	if len(groups) <= maxExhaustiveGroups:
+		candidates = (build(wheelOrder) for wheelOrder in itertools.permutations(groups))
+		best = min(candidates,key=lambda ordered: sequenceSeconds(ordered,sensor,startWheel,None,switchSeconds))
+	else:
+		wheelOrder = []
+		wheel = startWheel
+		remaining = list(groups)
+		while remaining:
+			wheel = min(remaining,key=lambda candidate: wheelSeconds(sensor,wheel,candidate))
+			remaining.remove(wheel)
+			wheelOrder.append(wheel)
+		best = build(wheelOrder)
+	originalSeconds = sequenceSeconds(shots,sensor,startWheel,None,switchSeconds)
+	bestSeconds = sequenceSeconds(best,sensor,startWheel,None,switchSeconds)
+	if bestSeconds > originalSeconds: # never make things worse than the order the shotlist was written in
+		return shots,originalSeconds,originalSeconds
+	return best,originalSeconds,bestSeconds
+
+def printSchedule(shots,originalSeconds,scheduledSeconds):
+	print("Scheduled order of shots:")
+	for count, (light,wheel,exposure) in enumerate(shots):
+		print("\t%s\t%s"%(count+1,formatShot(light,wheel,exposure)))
+	print("Predicted wheel and light switching time is %.1f seconds instead of %.1f seconds, saving %.1f seconds"%(scheduledSeconds,originalSeconds,originalSeconds-scheduledSeconds))
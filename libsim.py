@@ -0,0 +1,255 @@
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, path
+from skimage import io
+from datetime import datetime
+import libshotlist
+from libtiming import phase
+from libstats import FrameStats
+import libstack
+
+"""
+Simulated camera for testing capture.py and estimating how long a shotlist will take without hardware attached
+Select it with sensor: Simulated in a profile (model: names the camera to imitate) or use capture.py --dry-run with any profile
+"""
+
+verbose = 3
+reportheader = '___MS__|_MAYBE_|_98THP_|__SAT__|__MIN__|__MAX__|______LIGHT______|______FILTER_____'
+exposureGoal = 0.85*2**16
+warnsaturation = 64000
+ambient = 20 # degrees C assumed at the start of a session
+coolingRate = 0.25 # degrees C per second
+
+# width, height, bits per pixel, readout and transfer seconds, seconds to open the camera
+models = {
+	'qhy600':(9576,6388,16,1.5,3),
+	'qhy411':(14208,10656,16,3.5,3),
+	'qhymini':(3856,2180,16,0.3,3),
+	'q15':(9576,6388,16,1.5,3),
+	'flir':(5472,3648,16,0.5,2),
+	'pixelink':(5472,3648,16,0.5,2),
+	'canon':(6960,4640,14,3,3),
+	'spencer':(6960,4640,14,3,4),
+	'kolarielph':(4000,3000,12,3,2)
+}
+
+class Clock():
+	"""
+	Real clock by default; a virtual clock adds up the time hardware would have taken instead of waiting for it
+	Each thread has its own virtual time, so devices sleeping on different threads overlap as they would for real
+	A thread starts at the latest time any thread has reached, and work handed to another thread carries its start time with wait() or submit()
+	slept is the latest time reached, which is how long the session would take
+	"""
+	def __init__(self,virtual=False):
+		self.virtual = virtual
+		self.lock = threading.Lock() # devices can sleep from different threads
+		self.local = threading.local()
+		self.slept = 0
+		self.synthesizing = 0 # time spent making up frames, which real hardware would not spend
+
+	def now(self):
+		""" Virtual time of the calling thread """
+		if not hasattr(self.local,'now'):
+			self.local.now = self.slept
+		return self.local.now
+
+	def wait(self,until):
+		""" The calling thread waits for something that finished at virtual time until """
+		self.advance(max(self.now(),until))
+
+	def advance(self,now):
+		self.local.now = now
+		with self.lock:
+			self.slept = max(self.slept,now)
+
+	def sleep(self,seconds):
+		self.advance(self.now()+seconds)
+		if not self.virtual:
+			time.sleep(seconds)
+
+	def submit(self,executor,function,*args):
+		"""
+		executor.submit() that starts no earlier than the calling thread's time, and whoever takes the result catches up with the time it finished
+		"""
+		start = self.now()
+		def timed():
+			self.wait(start)
+			return function(*args), self.now()
+		return ClockFuture(executor.submit(timed),self)
+
+class ClockFuture():
+	def __init__(self,future,clock):
+		self.future = future
+		self.clock = clock
+
+	def result(self):
+		value, finished = self.future.result()
+		self.clock.wait(finished)
+		return value
+
+class Simulator():
+	def __init__(self,clock=None):
+		self.reports = []
+		self.writer = None # capture.py attaches a FrameWriter for pipelined sessions
+		self.shot = None # capture.py attaches a ShotTiming for each shot
+		self.clock = clock if clock else Clock()
+		self.wheel = 'NoFilter'
+		self.exposureMS = 0
+		self.frame = None
+		self.executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix='SimulatedExposure')
+		self.onExposed = None # same exposure completion interface as libqhy
+		self.exposureGoal = exposureGoal
+		self.warnsaturation = warnsaturation
+		self.testBinning = 1
+
+	def session(self,config,target):
+		self.config = config
+		self.target = target
+		self.model = str(config.get('model',config['sensor']))
+		w,h,bpp,readout,opening = models['qhy600']
+		for name in models:
+			if self.model.lower().startswith(name):
+				w,h,bpp,readout,opening = models[name]
+		self.w = int(config.get('width',w))
+		self.h = int(config.get('height',h))
+		self.bpp = int(config.get('bpp',bpp))
+		self.readout = float(config.get('readout',readout))
+		print("Simulating %s with %s × %s pixels at %s bits"%(self.model,self.w,self.h,self.bpp))
+		self.clock.sleep(opening)
+		self.cooled = self.clock.now()
+		if 'cool' in config and self.model.lower().startswith(('qhy','q15')):
+			print("Simulating cooling to %s while the lights are set up"%(config['cool']))
+			self.cooled += max(0,(ambient-0.98*config['cool'])/coolingRate)
+		start = time.monotonic()
+		rng = np.random.default_rng(0)
+		self.maxval = 2**self.bpp-1
+		self.base = rng.integers(int(0.02*self.maxval),int(0.04*self.maxval),(self.h,self.w),dtype=np.uint16) # bias and read noise
+		self.frame = np.empty_like(self.base)
+		self.clock.synthesizing += time.monotonic() - start
+
+	def showInfo(self):
+		print("Simulated camera %s properties"%(self.model))
+		print("\twidth in pixels = %s"%(self.w))
+		print("\theight in pixels = %s"%(self.h))
+		print("\tbpp = %s"%(self.bpp))
+		print("\treadout seconds = %s"%(self.readout))
+
+	def waitCooled(self):
+		seconds = max(0,self.cooled-self.clock.now())
+		print("Simulating %.0f more seconds of cooling"%(seconds)) if verbose > 3 else None
+		self.clock.sleep(seconds)
+
+	def setWheel(self,wheelNewPosition):
+		seconds = libshotlist.wheelSeconds(self.model,self.wheel,wheelNewPosition)
+		print("Simulating %s seconds to move wheel from %s to %s"%(seconds,self.wheel,wheelNewPosition)) if verbose > 3 else None
+		self.clock.sleep(seconds)
+		if self.shot and self.clock.virtual:
+			self.shot.add('wheel',seconds)
+		self.wheel = wheelNewPosition
+
+	def SetExposure(self,exposureMS):
+		self.exposureMS = exposureMS
+
+	def GetSingleFrame(self):
+		return self.startExposure().result()
+
+	def startExposure(self):
+		return self.clock.submit(self.executor,self.exposeAndRead)
+
+	def exposeAndRead(self):
+		exposureStart = time.monotonic()
+		self.clock.sleep(self.exposureMS/1000)
+		if self.onExposed:
+			self.onExposed()
+		readoutStart = time.monotonic()
+		self.clock.sleep(self.readout)
+		if self.shot: # record modeled rather than measured time so dry runs show where time would go
+			if 'cool' in self.config:
+				self.shot.record['telemetry'] = {'temperature':float(self.config['cool'])}
+			self.shot.add('exposure',self.exposureMS/1000,exposureStart)
+			self.shot.add('readout',self.readout,readoutStart)
+		start = time.monotonic()
+		level = min(int(self.exposureMS*0.02*self.maxval/1000),self.maxval-int(0.04*self.maxval)) # fills about 2% of range per second
+		np.add(self.base,level,out=self.frame,casting='unsafe')
+		self.clock.synthesizing += time.monotonic() - start
+		return self.frame
+
+	def beginTestFrames(self,binXY):
+		self.testBinning = binXY
+
+	def testFrame(self,exposureMS):
+		seconds = exposureMS/self.testBinning**2/1000 + self.readout/self.testBinning**2
+		self.clock.sleep(seconds)
+		start = time.monotonic()
+		level = min(int(exposureMS*0.02*self.maxval/1000),self.maxval-int(0.04*self.maxval))
+		test = self.base[::self.testBinning,::self.testBinning] + np.uint16(level)
+		self.clock.synthesizing += time.monotonic() - start
+		return test
+
+	def endTestFrames(self):
+		self.testBinning = 1
+
+	def shoot(self,light,wheel,exposure,frames=1):
+		self.SetExposure(int(exposure))
+		if frames > 1:
+			accumulator = libstack.Accumulator()
+			for frame in range(frames):
+				img = self.startExposure().result()
+				with phase(self.shot,'postprocess'):
+					accumulator.add(img)
+			timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+			if self.writer:
+				self.writer.submit(libstack.saveAverage,self.saveFrame,accumulator,light,wheel,exposure,timestamp,self.shot,shot=self.shot)
+			else:
+				libstack.saveAverage(self.saveFrame,accumulator,light,wheel,exposure,timestamp,self.shot)
+			return
+		img = self.startExposure().result()
+		timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+		if self.writer:
+			self.writer.submit(self.saveFrame,img.copy(),light,wheel,exposure,timestamp,self.shot,shot=self.shot) # copy because the next exposure overwrites the frame
+		else:
+			self.saveFrame(img,light,wheel,exposure,timestamp,self.shot)
+
+	def saveFrame(self,img,light,wheel,exposure,timestamp,shot=None):
+		with phase(shot,'statistics'):
+			report = FrameStats(img).report(exposure,light,wheel,exposureGoal,warnsaturation)
+		print(reportheader)
+		print(report)
+		self.reports.append(report)
+		directory = path.join(self.config['basepath'],self.target,'Raw')
+		if not path.exists(directory):
+			makedirs(directory)
+		fileExtension = 'tif'
+		if 'cool' in self.config:
+			gainDesc = 'gain'+str(self.config['gain'])+'_'+str(self.config['cool']).strip('-')
+		else:
+			gainDesc = 'gain'+str(self.config['gain'])
+		outfileName = '-'.join([
+			self.target,
+			self.config['sensor'],
+			self.config['lens'],
+			self.config['aperture'],
+			gainDesc,
+			light,
+			wheel,
+			str(exposure)+'ms',
+			timestamp+'.'+fileExtension])
+		outfilePath = path.join(directory,outfileName)
+		print("Saving %s"%(outfilePath))
+		with phase(shot,'write'):
+			io.imsave(outfilePath,img,check_contrast=False)
+		if shot:
+			shot.saved(outfilePath)
+		return outfilePath
+
+	def close(self):
+		print(reportheader)
+		for report in self.reports:
+			print(report)
+		print("Closing simulated %s"%(self.model))
+		self.executor.shutdown()
+
+if __name__ == "__main__":
+	print("This is not meant to be run but called from capture.py")
@@ -0,0 +1,213 @@
+import json
+import os
+import resource
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, path
+from skimage import io
+from libtiming import phase
+
+"""
+Combining frames of the same shot
+Shotlist lines ending in -xN, like uv385-NoFilter-12000ms-x8, take N frames back to back and fold each into an Accumulator as it arrives
+The average is saved in Raw under the usual filename and the per-pixel standard deviation in a sibling Noise directory
+Memory holds three float32 frames however many frames are averaged
+Master darks and measure.py combine many saved frames band by band, memory mapping the TIFFs, so the whole stack never has to fit in memory
+Each band is split into strips of rows combined on separate threads, since NumPy lets go of the GIL while it works
+Stacking modes:
+	median, exact but slow, as it partitions every column of pixels
+	mean, fastest, but a hot pixel or cosmic ray in one frame shows in the result
+	sigmaclip, mean of the frames within kappa standard deviations of the mean of the other frames, so even 3 frames can reject an outlier
+	minmax, mean after dropping the lowest and highest value of each pixel
+	auto, sigmaclip with 3 or more frames, otherwise mean
+"""
+
+verbose = 3
+stackBudget = 1024 # megabytes for one band of a stack
+modes = ('auto','median','mean','sigmaclip','minmax')
+kappa = 3.0 # standard deviations from the other frames at which sigmaclip rejects a value
+clipFrames = 3 # fewest frames from which sigmaclip and minmax can reject anything
+
+class Accumulator():
+	"""
+	Running mean and variance by Welford's method
+	"""
+	def __init__(self,variance=True):
+		self.count = 0
+		self.mean = None
+		self.m2 = None # sum of squared differences from the mean
+		self.scratch = None
+		self.variance = variance
+
+	def add(self,frame):
+		self.count += 1
+		if self.mean is None:
+			self.dtype = frame.dtype
+			self.mean = frame.astype(np.float32)
+			self.scratch = np.empty_like(self.mean)
+			if self.variance:
+				self.m2 = np.zeros_like(self.mean)
+			return
+		np.subtract(frame,self.mean,out=self.scratch,casting='unsafe') # difference from the previous mean
+		self.scratch /= self.count
+		self.mean += self.scratch
+		if self.variance:
+			np.square(self.scratch,out=self.scratch) # (x - old mean)(x - new mean) is the square of the step times n(n - 1)
+			self.scratch *= self.count*(self.count-1)
+			self.m2 += self.scratch
+
+	def average(self):
+		""" Mean rounded back to the type of the frames """
+		if np.issubdtype(self.dtype,np.integer):
+			limits = np.iinfo(self.dtype)
+			np.rint(self.mean,out=self.scratch)
+			np.clip(self.scratch,limits.min,limits.max,out=self.scratch)
+			return self.scratch.astype(self.dtype)
+		return self.mean.astype(self.dtype)
+
+	def noise(self):
+		""" Per-pixel sample standard deviation, float32 """
+		if self.m2 is None or self.count < 2:
+			return None
+		self.m2 /= self.count-1
+		return np.sqrt(self.m2,out=self.m2) # m2 is not needed again
+
+def noisePath(rawPath):
+	directory, filename = path.split(rawPath)
+	return path.join(path.dirname(directory),'Noise',filename)
+
+def saveAverage(saveFrame,accumulator,light,wheel,exposure,timestamp,shot=None):
+	"""
+	Saves the average with the driver's saveFrame, which returns the path it saved to, and the noise map beside it
+	"""
+	with phase(shot,'postprocess'):
+		average = accumulator.average()
+	outfilePath = saveFrame(average,light,wheel,exposure,timestamp,shot)
+	noise = accumulator.noise()
+	if noise is None:
+		return
+	outfilePath = noisePath(outfilePath)
+	if not path.exists(path.dirname(outfilePath)):
+		makedirs(path.dirname(outfilePath))
+	print("Saving standard deviation of %s frames to %s"%(accumulator.count,outfilePath)) if verbose > 2 else None
+	with phase(shot,'write'):
+		io.imsave(outfilePath,noise,check_contrast=False)
+	if shot:
+		shot.saved(outfilePath)
+
+def openFrame(filePath):
+	"""
+	Memory map of an uncompressed TIFF, which reads only the rows used, or the decoded image if it cannot be mapped
+	"""
+	import tifffile
+	try:
+		return tifffile.memmap(filePath,mode='r')
+	except ValueError:
+		print("%s cannot be memory mapped (compressed?), reading it whole"%(filePath)) if verbose > 2 else None
+		return io.imread(filePath)
+
+def bandRows(frames,budget=stackBudget):
+	""" Rows per band so that the band of every frame as float32, plus the copy made while stacking, stays within budget megabytes """
+	rowBytes = 2*len(frames)*frames[0][0].size*4
+	return max(1,int(budget*2**20//rowBytes))
+
+def stackSettings(mode,count):
+	"""
+	Mode that stacking count frames will use and its parameters, as recorded in the description of the result
+	"""
+	if mode not in modes:
+		raise ValueError("Unknown stacking mode %s, choose from %s"%(mode,', '.join(modes)))
+	if mode == 'auto':
+		mode = 'sigmaclip' if count >= clipFrames else 'mean'
+	elif mode in ('sigmaclip','minmax') and count < clipFrames:
+		print("Only %s frames, too few for %s, so taking the mean"%(count,mode)) if verbose > 1 else None
+		mode = 'mean'
+	settings = {'stack':mode,'frames':count}
+	if mode == 'sigmaclip':
+		settings['kappa'] = kappa
+	return settings
+
+def medianKernel(band,out,settings):
+	np.median(band,axis=0,out=out)
+
+def meanKernel(band,out,settings):
+	np.mean(band,axis=0,out=out)
+
+def sigmaclipKernel(band,out,settings):
+	"""
+	Leaving each frame out in turn, its value is kept if within kappa sample standard deviations of the mean of the others
+	Both come from the mean and squared deviations of all frames, so each frame is visited twice and nothing is sorted
+	"""
+	count = len(band)
+	mean = np.mean(band,axis=0)
+	squares = np.zeros_like(mean)
+	for frame in band:
+		deviation = frame - mean
+		squares += deviation*deviation
+	total = np.zeros_like(mean)
+	kept = np.zeros_like(mean)
+	limit = settings['kappa']**2
+	for frame in band:
+		deviation = (frame - mean)*(count/(count-1)) # from the mean of the other frames
+		others = (squares - deviation*deviation*((count-1)/count))/(count-2) # variance of the other frames
+		keep = deviation*deviation <= limit*others
+		np.add(total,frame,out=total,where=keep)
+		kept += keep
+	np.divide(total,kept,out=mean,where=kept>0) # the mean stands where every value was rejected
+	out[...] = mean
+
+def minmaxKernel(band,out,settings):
+	total = np.sum(band,axis=0,dtype=out.dtype)
+	total -= np.min(band,axis=0)
+	total -= np.max(band,axis=0)
+	np.divide(total,len(band)-2,out=out)
+
+kernels = {'median':medianKernel,'mean':meanKernel,'sigmaclip':sigmaclipKernel,'minmax':minmaxKernel}
+
+def stack(filePaths,mode='median',convert=None,budget=stackBudget,threads=None):
+	"""
+	Combines the frames in filePaths pixel by pixel, a band of rows at a time, with each band split into strips across threads
+	convert (such as img_as_float32) is applied to each band, exactly as it would be to whole frames, so the result is identical to stacking the whole cube
+	"""
+	settings = mode if isinstance(mode,dict) else stackSettings(mode,len(filePaths))
+	kernel = kernels[settings['stack']]
+	frames = [openFrame(filePath) for filePath in filePaths]
+	rows = bandRows(frames,budget)
+	height = frames[0].shape[0]
+	threads = threads or os.cpu_count() or 1
+	print("Taking the %s of %s frames in bands of %s rows on %s threads"%(settings['stack'],len(frames),rows,threads)) if verbose > 3 else None
+	def read(frame,top):
+		return convert(frame[top:top+rows]) if convert else np.asarray(frame[top:top+rows])
+	result = None
+	with ThreadPoolExecutor(max_workers=threads,thread_name_prefix='stack') as executor:
+		for top in range(0,height,rows):
+			band = np.stack(list(executor.map(read,frames,[top]*len(frames))))
+			if result is None:
+				result = np.empty((height,)+band.shape[2:],dtype=np.result_type(band.dtype,np.float32))
+			bottom = top + len(band[0])
+			strips = np.array_split(np.arange(top,bottom),min(threads,bottom-top))
+			list(executor.map(lambda strip: kernel(band[:,strip[0]-top:strip[-1]+1-top],result[strip[0]:strip[-1]+1],settings),strips))
+			del band
+	return result
+
+def saveStack(filePath,image,settings):
+	""" Saves a stack with its mode and parameters as JSON in the TIFF description """
+	import tifffile
+	tifffile.imwrite(filePath,image,description=json.dumps(settings))
+
+def readSettings(filePath):
+	""" Mode and parameters saved with a stack or dark model, or an empty dictionary for stacks saved without them """
+	import tifffile
+	with tifffile.TiffFile(filePath) as tiff:
+		try:
+			settings = json.loads(tiff.pages[0].description)
+		except ValueError:
+			return {}
+	return settings if isinstance(settings,dict) and ('stack' in settings or 'model' in settings) else {}
+
+def peakMemory():
+	""" Most memory this process has held, in megabytes """
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 # kilobytes on Linux
+
+if __name__ == "__main__":
+	print("This is not meant to be run but called from the camera drivers, darksubtract.py, and measure.py")
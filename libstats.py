@@ -0,0 +1,87 @@
+import numpy as np
+
+"""
+Frame statistics from a single pass over the image
+For 8 and 16 bit images one bincount gives a histogram of every possible value, and percentiles, min, max, saturation, mean, and deviation all come from it
+Percentiles match np.percentile with its default linear interpolation
+Other data types fall back to ordinary numpy calls
+"""
+
+reportheader = '___MS__|_MAYBE_|_98THP_|__SAT__|__MIN__|__MAX__|______LIGHT______|______FILTER_____'
+chunk = 2**22 # pixels per bincount, which keeps the temporary index array small
+
+class FrameStats():
+	def __init__(self,img):
+		self.count = img.size
+		self.img = None
+		if img.dtype.kind == 'u' and img.dtype.itemsize <= 2:
+			flat = img.ravel()
+			self.counts = np.zeros(2**(8*img.dtype.itemsize),dtype=np.int64)
+			for start in range(0,flat.size,chunk):
+				self.counts += np.bincount(flat[start:start+chunk],minlength=self.counts.size)
+			self.cumulative = np.cumsum(self.counts)
+			occupied = np.flatnonzero(self.counts)
+			self.min = int(occupied[0])
+			self.max = int(occupied[-1])
+			self.zeros = int(self.counts[0])
+			values = np.arange(self.counts.size,dtype=np.float64)
+			self.mean = float(np.dot(values,self.counts)/self.count)
+			self.std = float(np.sqrt(np.dot((values-self.mean)**2,self.counts)/self.count))
+		else:
+			self.img = img
+			self.min = np.min(img)
+			self.max = np.max(img)
+			self.zeros = self.count - int(np.count_nonzero(img))
+			self.mean = float(np.mean(img))
+			self.std = float(np.std(img))
+
+	def valueAtRank(self,rank):
+		return int(np.searchsorted(self.cumulative,rank,side='right'))
+
+	def percentile(self,q):
+		if self.img is not None:
+			return np.percentile(self.img,q)
+		rank = (self.count-1)*q/100
+		lower = int(np.floor(rank))
+		fraction = rank - lower
+		low = self.valueAtRank(lower)
+		if fraction == 0:
+			return float(low)
+		high = self.valueAtRank(lower+1)
+		return low + fraction*(high-low)
+
+	def median(self):
+		return self.percentile(50)
+
+	def above(self,threshold):
+		if self.img is not None:
+			return int(np.count_nonzero(self.img > threshold))
+		if threshold < 0:
+			return self.count
+		if threshold >= self.counts.size-1:
+			return 0
+		return int(self.count - self.cumulative[int(np.floor(threshold))])
+
+	def saturatedpct(self,warnsaturation):
+		"""
+		Percent of nonzero pixels above warnsaturation, as the drivers have always reported it
+		"""
+		return 100 * self.above(warnsaturation) / max(self.count - self.zeros,1) # an all black frame has none
+
+	def suggestion(self,exposure,exposureGoal):
+		return exposureGoal*int(exposure)/max(self.percentile(98),1) # a mostly black frame has a 98th percentile of 0
+
+	def histogram(self,bins=256,range=None):
+		"""
+		Same counts and edges as np.histogram(img,bins,range) without another pass over the image
+		"""
+		if self.img is not None:
+			return np.histogram(self.img,bins=bins,range=range)
+		if range is None:
+			range = (self.min,self.max)
+		occupied = np.flatnonzero(self.counts)
+		return np.histogram(occupied,bins=bins,range=range,weights=self.counts[occupied])
+
+	def report(self,exposure,light,wheel,exposureGoal,warnsaturation):
+		p98 = self.percentile(98)
+		return f"{exposure:_>6}_|{self.suggestion(exposure,exposureGoal):_>6.0f}_|{p98:_>6.0f}_|{self.saturatedpct(warnsaturation):_>5.1f}%_|{self.min:_>6}_|{self.max:_>6}_|{light:_^17}|{wheel:_^17}"
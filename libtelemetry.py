@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import deque
+
+"""
+Samples camera health in the background for as long as the camera is open
+Each sample is the time and a dictionary of readings: temperature (degrees C), power (percent of the cooler's maximum), and humidity where the camera has a sensor
+Cooling is stable once the temperature stops changing, judged by its slope over the last window of samples rather than a fixed threshold
+Frames are stamped with the latest readings, which end up in the timing log and the journal
+"""
+
+verbose = 3
+period = 1 # seconds between samples
+length = 3600 # samples kept in memory
+window = 30 # seconds of samples for the rate of change
+maxRate = 0.2 # degrees C per minute still counted as stable
+tolerance = 0.5 # degrees C from the setpoint counted as reaching it
+fullPower = 95 # percent of cooler power at which the setpoint may be out of reach on a warm day
+reportSeconds = 10 # between messages while waiting
+
+class Telemetry():
+	def __init__(self,read,period=period):
+		self.read = read # function returning a dictionary of readings
+		self.period = period
+		self.samples = deque(maxlen=length)
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run,name='Telemetry',daemon=True)
+		self.thread.start()
+
+	def run(self):
+		while not self.stopped.is_set():
+			try:
+				sample = (time.monotonic(),self.read())
+			except Exception as e:
+				print("Telemetry reading failed: %s"%(e)) if verbose > 3 else None
+			else:
+				with self.lock:
+					self.samples.append(sample)
+			self.stopped.wait(self.period)
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+
+	def latest(self):
+		with self.lock:
+			return dict(self.samples[-1][1]) if self.samples else {}
+
+	def rate(self,key='temperature',seconds=None):
+		"""
+		Least squares slope per minute over the last seconds of samples (default window), or None until that many seconds have been sampled
+		"""
+		seconds = seconds or window
+		with self.lock:
+			if len(self.samples) == 0:
+				return None
+			end = self.samples[-1][0]
+			points = [(t,reading[key]) for t, reading in self.samples if t >= end-seconds and key in reading]
+		if len(points) < 3 or points[-1][0] - points[0][0] < 0.9*seconds:
+			return None
+		meanT = sum(t for t, value in points)/len(points)
+		meanValue = sum(value for t, value in points)/len(points)
+		variance = sum((t-meanT)**2 for t, value in points)
+		return 60*sum((t-meanT)*(value-meanValue) for t, value in points)/variance
+
+	def stable(self,setpoint):
+		"""
+		True once the temperature has stopped changing, either at the setpoint or wherever the cooler at full power holds it
+		"""
+		rate = self.rate()
+		if rate is None or abs(rate) > maxRate:
+			return False
+		reading = self.latest()
+		return abs(reading['temperature']-setpoint) <= tolerance or reading.get('power',0) >= fullPower
+
+	def waitStable(self,setpoint,timeout):
+		start = time.monotonic()
+		nextReport = start
+		while not self.stable(setpoint):
+			now = time.monotonic()
+			reading = self.latest()
+			if now - start > timeout:
+				print("Sensor temperature has not settled after %s seconds, going ahead at %s°C"%(timeout,reading.get('temperature')))
+				return False
+			if now >= nextReport and reading:
+				rate = self.rate()
+				print("Waiting for sensor temperature %.1f°C to settle near %s°C (changing %s°C per minute, cooler at %.0f%%)"%(reading['temperature'],setpoint,'?' if rate is None else '%.2f'%(rate),reading.get('power',0)))
+				nextReport = now + reportSeconds
+			time.sleep(self.period)
+		reading = self.latest()
+		if abs(reading['temperature']-setpoint) > tolerance:
+			print("Sensor temperature is stable at %.1f°C, the coldest the cooler can hold rather than %s°C"%(reading['temperature'],setpoint))
+		else:
+			print("Sensor temperature is stable at %.1f°C"%(reading['temperature'])) if verbose > 2 else None
+		return True
+
+if __name__ == "__main__":
+	print("This is not meant to be run but called from libqhy.py")
@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from os import makedirs, path
+
+"""
+Per-phase timing of capture sessions
+capture.py begins a ShotTiming for each shot and hands it to the camera as camera.shot
+Drivers wrap their work in phase(self.shot,'exposure') and so on; each finished shot is appended as one line of JSON to a session log next to Raw
+"""
+
+verbose = 3
+phaseOrder = ['wheel','lighton','settle','autoexposure','exposure','readout','transfer','statistics','postprocess','write','lightoff']
+
+def phase(shot,name):
+	if shot is None:
+		return nullcontext()
+	return shot.phase(name)
+
+class ShotTiming():
+	def __init__(self,session,light,wheel,exposure,occurrence=0):
+		self.session = session
+		self.lock = threading.Lock()
+		self.pending = 1 # released by capture.py at the end of the shot and by the writer when it finishes
+		self.record = {'light':light,'wheel':wheel,'exposure':exposure,'key':[light,wheel,exposure],'occurrence':occurrence,'start':time.monotonic(),'phases':{},'files':[]}
+		self.done = session.journal is not None and session.journal.isDone(light,wheel,exposure,occurrence) # already taken in a session being resumed
+
+	@contextmanager
+	def phase(self,name):
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.add(name,time.monotonic()-start,start)
+
+	def add(self,name,seconds,start=None):
+		with self.lock:
+			if name in self.record['phases']: # a phase can happen more than once, e.g. one write per Bayer channel
+				self.record['phases'][name]['seconds'] += seconds
+			else:
+				self.record['phases'][name] = {'start':start if start is not None else time.monotonic(),'seconds':seconds}
+
+	def saved(self,outfilePath):
+		with self.lock:
+			self.record['files'].append(outfilePath)
+
+	def hold(self):
+		with self.lock:
+			self.pending += 1
+
+	def release(self):
+		with self.lock:
+			self.pending -= 1
+			done = self.pending == 0
+			if done:
+				self.record['end'] = time.monotonic()
+		if done:
+			self.session.append(self)
+
+class SessionTiming():
+	def __init__(self,directory,journal=None):
+		if not path.exists(directory):
+			makedirs(directory)
+		self.path = path.join(directory,'timing-'+datetime.now().strftime("%Y%m%d_%H%M%S")+'.jsonl')
+		self.lock = threading.Lock()
+		self.start = time.monotonic()
+		self.shots = 0
+		self.totals = {}
+		self.journal = journal # a libjournal.Journal records each shot once its files are saved
+		self.occurrences = {}
+		print("Recording shot timing in %s"%(self.path)) if verbose > 2 else None
+
+	def rewind(self):
+		""" Count repeated shots from the top of the shotlist again, so that starting over skips shots already in the journal """
+		self.occurrences = {}
+
+	def begin(self,light,wheel,exposure):
+		occurrence = self.occurrences.get((light,wheel,exposure),0) # shotlists can repeat a shot
+		self.occurrences[(light,wheel,exposure)] = occurrence + 1
+		return ShotTiming(self,light,wheel,exposure,occurrence)
+
+	def append(self,shot):
+		with self.lock:
+			self.shots += 1
+			for name, timing in shot.record['phases'].items():
+				self.totals[name] = self.totals.get(name,0) + timing['seconds']
+			with open(self.path,'a') as log:
+				log.write(json.dumps(shot.record)+'\n')
+		if self.journal:
+			self.journal.complete(shot.record)
+
+	def close(self,elapsed=None):
+		if elapsed is None: # a dry run passes in modeled time
+			elapsed = time.monotonic() - self.start
+		print("Where the time went in %s shots over %.1f seconds:"%(self.shots,elapsed))
+		print("______PHASE______|_SECONDS_|_PER_SHOT_|_SHARE_")
+		names = [name for name in phaseOrder if name in self.totals] + [name for name in self.totals if name not in phaseOrder]
+		for name in names:
+			total = self.totals[name]
+			print(f"{name:_^17}|{total:_>8.1f}_|{total/max(self.shots,1):_>9.2f}_|{100*total/max(elapsed,1e-9):_>5.1f}%")
+		print("Phases in the background writer overlap with the next shot, so shares can add up to more than 100%") if verbose > 3 else None
@@ -0,0 +1,83 @@
+from os import makedirs, path
+
+"""
+Filter wheel travel times learned for each camera
+capture.py --calibrate-wheel times every move the wheel can report, and moves during sessions refine the times
+Saved in ~/.config/JubPalCapture/wheel.yaml by camera id, such as QHY600M-1234567890abcdef
+Moves that cannot be timed (to slot 1, which the wheel reports while still moving) are estimated from timed moves of the same distance, and libqhy waits that long instead of its fixed wait
+"""
+
+verbose = 3
+wheelPath = path.expanduser('~/.config/JubPalCapture/wheel.yaml')
+wheelSlots = 7
+margin = 1.2 # estimates wait this much longer than the timed moves they come from
+learningRate = 0.25 # weight of each new timing against what was known
+
+def readWheel():
+	if not path.exists(wheelPath):
+		return {}
+	import yaml
+	with open(wheelPath,'r') as unparsedyaml:
+		return yaml.load(unparsedyaml,Loader=yaml.SafeLoader) or {}
+
+class WheelModel():
+	def __init__(self,cameraId):
+		self.cameraId = cameraId
+		self.moves = readWheel().get(cameraId,{}) # {fromSlot: {toSlot: seconds}}
+		self.changed = False
+
+	@classmethod
+	def forSensor(cls,sensor):
+		"""
+		Model for the first calibrated camera whose id begins with the sensor named in a profile, or None
+		"""
+		for cameraId in readWheel():
+			if cameraId.lower().startswith(sensor.lower()):
+				return cls(cameraId)
+		return None
+
+	def distance(self,fromSlot,toSlot):
+		distance = abs(toSlot - fromSlot)
+		return min(distance,wheelSlots-distance) # wheel can turn either way
+
+	def seconds(self,fromSlot,toSlot):
+		"""
+		Timed seconds for this move, an estimate from timed moves of the same distance, or None
+		"""
+		if fromSlot == toSlot:
+			return 0
+		if toSlot in self.moves.get(fromSlot,{}):
+			return self.moves[fromSlot][toSlot]
+		similar = [seconds for start, ends in self.moves.items() for end, seconds in ends.items() if self.distance(start,end) == self.distance(fromSlot,toSlot)]
+		if len(similar) == 0:
+			return None
+		return margin*max(similar)
+
+	def wait(self,fromSlot,toSlot,uncalibrated):
+		"""
+		Seconds to wait for a move whose end cannot be seen: the timed seconds with the margin, an estimate (which already has it), or the fixed wait when nothing similar has been timed
+		"""
+		if toSlot in self.moves.get(fromSlot,{}):
+			return margin*self.moves[fromSlot][toSlot]
+		seconds = self.seconds(fromSlot,toSlot)
+		return uncalibrated if seconds is None else seconds
+
+	def observe(self,fromSlot,toSlot,seconds):
+		known = self.moves.setdefault(fromSlot,{})
+		if toSlot in known:
+			seconds = (1-learningRate)*known[toSlot] + learningRate*seconds
+		known[toSlot] = round(seconds,3)
+		self.changed = True
+
+	def save(self):
+		if not self.changed:
+			return
+		import yaml
+		wheels = readWheel()
+		wheels[self.cameraId] = self.moves
+		if not path.exists(path.dirname(wheelPath)):
+			makedirs(path.dirname(wheelPath))
+		with open(wheelPath,'w') as unparsedyaml:
+			yaml.dump(wheels,unparsedyaml)
+		self.changed = False
+		print("Saved filter wheel times for %s in %s"%(self.cameraId,wheelPath)) if verbose > 2 else None
@@ -0,0 +1,51 @@
+import queue
+import threading
+
+verbose = 3
+
+class FrameWriter():
+	"""
+	Background stage that analyzes and saves finished frames so the next exposure can begin right away
+	The queue is bounded so that a slow disk holds up the camera rather than filling memory with frames
+	Drivers hand work to submit() and capture.py calls close() before closing the camera
+	"""
+	def __init__(self,depth=2):
+		self.depth = depth
+		self.queue = queue.Queue(maxsize=depth)
+		self.failures = []
+		self.thread = threading.Thread(target=self.work,name='FrameWriter',daemon=True)
+		self.thread.start()
+		print("Writing frames in the background with up to %s frames waiting"%(depth)) if verbose > 3 else None
+
+	def submit(self,function,*args,shot=None):
+		if shot:
+			shot.hold() # timing for the shot is logged once the write finishes
+		if self.queue.full():
+			print("Waiting for the writer to catch up") if verbose > 2 else None
+		self.queue.put((function,args,shot)) # blocks while the queue is full
+
+	def work(self):
+		while True:
+			job = self.queue.get()
+			if job is None:
+				self.queue.task_done()
+				break
+			function,args,shot = job
+			try:
+				function(*args)
+			except Exception as e:
+				print("Background analysis or save failed: %s"%(e))
+				self.failures.append(e)
+			if shot:
+				shot.release()
+			self.queue.task_done()
+
+	def flush(self):
+		self.queue.join()
+
+	def close(self):
+		print("Waiting for background writes to finish") if verbose > 2 else None
+		self.queue.put(None)
+		self.thread.join()
+		if len(self.failures) > 0:
+			print("%s background writes failed, check the messages above"%(len(self.failures)))
@@ -1,40 +1,110 @@
 import time
+import threading
+from os import makedirs, path
+from libtiming import phase
 
 verbose = 3
+settlePath = path.expanduser('~/.config/JubPalCapture/settle.yaml') # written by capture.py --calibrate-settle
+defaultSettle = 0.5 # seconds of head start for lights that have not been calibrated
+
+def readSettle(lights):
+	"""
+	Calibrated settle seconds for each light of one kind of light array, such as {'uv385': 0.12}
+	"""
+	if not path.exists(settlePath):
+		return {}
+	import yaml
+	with open(settlePath,'r') as unparsedyaml:
+		calibration = yaml.load(unparsedyaml,Loader=yaml.SafeLoader) or {}
+	return calibration.get(lights.lower(),{})
+
+def writeSettle(lights,settle):
+	import yaml
+	calibration = {}
+	if path.exists(settlePath):
+		with open(settlePath,'r') as unparsedyaml:
+			calibration = yaml.load(unparsedyaml,Loader=yaml.SafeLoader) or {}
+	calibration.setdefault(lights.lower(),{}).update(settle)
+	if not path.exists(path.dirname(settlePath)):
+		makedirs(path.dirname(settlePath))
+	with open(settlePath,'w') as unparsedyaml:
+		yaml.dump(calibration,unparsedyaml)
+	print("Saved settle times for %s lights in %s"%(lights,settlePath))
+
+def waitReady(lightArray,light,sleep=time.sleep):
+	"""
+	Waits until a light that was just turned on is steady enough to expose and returns the seconds waited
+	A light array whose firmware acknowledges can offer ready(light); otherwise wait the calibrated settle time for that light, or the default head start
+	"""
+	if hasattr(lightArray,'ready'):
+		return lightArray.ready(light)
+	settle = getattr(lightArray,'settle',{})
+	seconds = max(settle.get(name,defaultSettle) for name in light.split('+')) # several lights at once wait for the slowest
+	sleep(seconds)
+	return seconds
+
+class Strobe:
+	"""
+	Turns the light off the moment the exposure ends rather than after readout and saving, to limit light on the artifact
+	Cameras with onExposed (QHY and simulated) call it when the sensor stops integrating; other cameras do not know when their exposure really begins, so preflight refuses --strobe for them
+	"""
+	def __init__(self,lightArray,camera):
+		self.lightArray = lightArray
+		self.camera = camera
+		self.lock = threading.Lock()
+		self.lit = False
+	def arm(self,exposure,shot):
+		self.shot = shot
+		self.lit = True
+		if hasattr(self.camera,'onExposed'):
+			self.camera.onExposed = self.off # otherwise the light goes off in finish(), as without --strobe
+	def off(self):
+		with self.lock:
+			if not self.lit:
+				return
+			self.lit = False
+			with phase(self.shot,'lightoff'):
+				self.lightArray.off()
+	def finish(self):
+		""" After shoot() returns, in case the camera never reported the end of exposure """
+		if hasattr(self.camera,'onExposed'):
+			self.camera.onExposed = None
+		self.off()
 
 class Octopus: # Arduino is the default Octopus, specify 2023 or Bluetooth for variants
+	port0 = (0,9)
+	test = (0,9) # format is port, octopus index where 9 is all octopodes
+	testRight = (0,0)
+	testLeft = (0,1)
+	port1 = (1,9)
+	white6500 = (1,9)
+	white6500Right = (1,1)
+	white6500Left = (1,0)
+	port2 = (2,9)
+	white2800 = (2,9)
+	white2800Right = (2,1)
+	white2800Left = (2,0)
+	port3 = (3,9)
+	uv385 = (3,9)
+	port4 = (4,9)
+	uv405 = (4,9)
+	port5 = (5,9)
+	blue475 = (5,9)
+	blue475Right = (5,1)
+	blue475Left = (5,0)
+	port6 = (6,9)
+	ir730 = (6,9)
+	port7 = (7,9)
+	ir850 = (7,9)
+	port8 = (8,9)
+	ir940 = (8,9)
+	raking = (8,9)
+	rakingRight = (8,1)
+	rakingLeft = (8,0)
 	def __init__(self):
 		import serial
 		import serial.tools.list_ports
-		self.port0 = (0,9)
-		self.test = (0,9) # format is port, octopus index where 9 is all octopodes
-		self.testRight = (0,0)
-		self.testLeft = (0,1)
-		self.port1 = (1,9)
-		self.white6500 = (1,9)
-		self.white6500Right = (1,1)
-		self.white6500Left = (1,0)
-		self.port2 = (2,9)
-		self.white2800 = (2,9)
-		self.white2800Right = (2,1)
-		self.white2800Left = (2,0)
-		self.port3 = (3,9)
-		self.uv385 = (3,9)
-		self.port4 = (4,9)
-		self.uv405 = (4,9)
-		self.port5 = (5,9)
-		self.blue475 = (5,9)
-		self.blue475Right = (5,1)
-		self.blue475Left = (5,0)
-		self.port6 = (6,9)
-		self.ir730 = (6,9)
-		self.port7 = (7,9)
-		self.ir850 = (7,9)
-		self.port8 = (8,9)
-		self.ir940 = (8,9)
-		self.raking = (8,9)
-		self.rakingRight = (8,1)
-		self.rakingLeft = (8,0)
+		from concurrent.futures import ThreadPoolExecutor
 		self.octopodes = []
 		ports = serial.tools.list_ports.comports()
 		for port in ports:
@@ -44,46 +114,69 @@ class Octopus: # Arduino is the default Octopus, specify 2023 or Bluetooth for v
 					octopus.open()
 				self.octopodes.append(octopus) # octopus comparable to self.led_connection
 				print("Connected to %s %s"%(port.name,port.description))
-	def on(self,light,exposure):
-		port = getattr(self,light)
-		try:
-			for num, octopus in enumerate(self.octopodes): 
+		self.lock = threading.Lock() # one command at a time
+		self.timing = {} # seconds each board took to write the last command
+		self.executor = ThreadPoolExecutor(max_workers=max(1,len(self.octopodes)),thread_name_prefix='Octopus') # a thread for each board
+	def commands(self,light):
+		"""
+		Bytes for each board index to turn on a light, or several lights joined with + such as white6500Left+white6500Right
+		"""
+		commands = {}
+		for name in light.split('+'):
+			port = getattr(self,name)
+			for num in range(len(self.octopodes)):
 				if port[1] > 8 or port[1] == num:
-					print("Asking Octopus index %s to turn on port %s for light %s for %s milliseconds"%(num,port[0],light,exposure))
-					octopus.write((port[0]+48).to_bytes(1)) # octopus interprets integer 0-8 as turn on that port; add 48 because
-		except:
-			print("Failure trying to write command %s-%s"%(port[0],port[1]))
+					commands[num] = commands.get(num,b'') + (port[0]+48).to_bytes(1) # octopus interprets integer 0-8 as turn on that port; add 48 because
+		return commands
+	def send(self,commands):
+		"""
+		Writes to every board in commands at the same moment: one thread per board, released together by a barrier, one write per board
+		Returns the seconds between the first and last board starting to write
+		"""
+		if len(commands) == 0:
+			return 0
+		with self.lock:
+			barrier = threading.Barrier(len(commands))
+			def write(num):
+				barrier.wait()
+				start = time.perf_counter()
+				self.octopodes[num].write(commands[num])
+				self.octopodes[num].flush()
+				return start, time.perf_counter() - start
+			futures = {num:self.executor.submit(write,num) for num in commands}
+			starts = []
+			self.timing = {}
+			for num, future in futures.items():
+				try:
+					start, seconds = future.result()
+					starts.append(start)
+					self.timing[self.octopodes[num].name] = seconds
+				except Exception as e:
+					print("Failure trying to write command %s to Octopus index %s on %s: %s"%(commands[num],num,self.octopodes[num].name,e))
+			skew = max(starts) - min(starts) if starts else 0
+			print("Octopus boards started writing within %.3f ms, writes took %s"%(1000*skew,', '.join("%s %.3f ms"%(name,1000*seconds) for name, seconds in self.timing.items()))) if verbose > 3 else None
+			return skew
+	def on(self,light,exposure):
+		print("Asking Octopus to turn on light %s for %s milliseconds"%(light,exposure))
+		self.send(self.commands(light))
+		waitReady(self,light)
 		time.sleep(int(exposure)/1000)
-		if True:
-			time.sleep(2) 
-		try:
-			for octopus in self.octopodes: 
-				octopus.write(int(58).to_bytes(1)) # octopus interprets a number greater than known ports (1 internal, 8 ports) as all off; add 48
-		except:
-			print("Failure trying to write command 10 for all off")
+		self.off()
 	def close(self):
+		self.executor.shutdown()
 		for octopus in self.octopodes:
 			print("Closing",octopus.name)
 			octopus.close()
 	def manualon(self,light):
-		port = getattr(self,light)
-		try:
-			for num, octopus in enumerate(self.octopodes): 
-				if port[1] > 8 or port[1] == num:
-					print("Asking Octopus index %s to turn on port %s for light %s indefinately"%(num,port[0],light)) if verbose > 3 else None
-					octopus.write((port[0]+48).to_bytes(1)) # octopus interprets integer 0-8 as turn on that port; add 48 because
-					print(f"Light {light} is on. It will not turn off unless you use the function off() to turn off all lights") if verbose > 3 else None
-		except:
-			print("Failure trying to write command %s-%s"%(port[0],port[1]))
+		print("Asking Octopus to turn on light %s indefinately"%(light)) if verbose > 3 else None
+		self.send(self.commands(light))
+		print(f"Light {light} is on. It will not turn off unless you use the function off() to turn off all lights") if verbose > 3 else None
 	def off(self):
-		try:
-			for octopus in self.octopodes: 
-				octopus.write(int(58).to_bytes(1)) # octopus interprets a number greater than known ports (1 internal, 8 ports) as all off; add 48
-				print("Successfully issued command to turn off all lights") if verbose > 3 else None
-		except:
-			print("Failure trying to write command 10 for all off")
+		self.send({num:int(58).to_bytes(1) for num in range(len(self.octopodes))}) # octopus interprets a number greater than known ports (1 internal, 8 ports) as all off; add 48
+		print("Issued command to turn off all lights") if verbose > 3 else None
 
 class Misha:
+	wavelengths = ['365','385','395','420','450','470','500','530','560','590','615','630','660','730','850','940']
 	def __init__(self):
 		import serial
 		import serial.tools.list_ports
@@ -99,7 +192,7 @@ class Misha:
 		if not self.led_connection.isOpen():
 				self.led_connection.open()
 	def on(self,light,exposure):
-		if light not in ['365','385','395','420','450','470','500','530','560','590','615','630','660','730','850','940']:
+		if light not in self.wavelengths:
 			print("I don't think Misha light panels will understand your request for light %s, but we can try…"%(light))
 		print("Turning on light %s for %s"%(light,exposure))
 		exposure = int(exposure.strip('ms'))
@@ -107,7 +200,7 @@ class Misha:
 		time.sleep(exposure/1000)
 		self.led_connection.write('0,0\n'.encode())
 	def manualon(self,light):
-		if light not in ['365','385','395','420','450','470','500','530','560','590','615','630','660','730','850','940']:
+		if light not in self.wavelengths:
 			print("I don't think Misha light panels will understand your request for light %s, but we can try…"%(light))
 		print("Turning on light %s"%(light))
 		self.led_connection.write((light + ',100\n').encode()) # wavelength,intensity(on a scale of 100)\n
@@ -131,6 +224,31 @@ class Overhead:
 	def close(self):
 		print("No need to close the overhead lights")
 
+class Simulated:
+	"""
+	Stands in for real lights with capture.py --dry-run or lights: Simulated in a profile
+	Models the pause while the lights it imitates open and a short delay for each command
+	"""
+	def __init__(self,model='Simulated',sleep=time.sleep):
+		self.sleep = sleep
+		self.commandSeconds = 0.002 # one serial write
+		if model.lower().startswith('octopus') or model.lower().startswith('misha'):
+			print("Simulating 2 seconds for %s lights to open"%(model))
+			self.sleep(2)
+	def on(self,light,exposure):
+		if isinstance(exposure,str):
+			exposure = int(exposure.strip('ms'))
+		self.manualon(light)
+		self.sleep(exposure/1000)
+		self.off()
+	def manualon(self,light):
+		print("Simulating light %s on"%(light)) if verbose > 3 else None
+		self.sleep(self.commandSeconds)
+	def off(self):
+		self.sleep(self.commandSeconds)
+	def close(self):
+		print("No need to close simulated lights")
+
 class Octopus2023:
 	class Ports:
 		Raking1 = 0x01
@@ -159,87 +277,134 @@ class Octopus2023:
 		pass
 
 class OctopusBluetooth:
-	def __init__(self):
+	"""
+	Octopus boards reached over Bluetooth LE (Nordic UART service)
+	The adapter and board addresses found are cached in ~/.cache/JubPalCapture, so later sessions scan only until those boards appear
+	Commands go to all boards at once; writeCommand=True skips waiting for each board to acknowledge
+	"""
+	serviceuuid = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E".lower()
+	characteristicRx = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E".lower()
+	cachePath = path.expanduser('~/.cache/JubPalCapture/bluetooth.yaml')
+	port0 = (0,9)
+	test = (0,9) # format is port, octopus index where 9 is all octopodes
+	testLeft = (0,0)
+	testRight = (0,1)
+	port1 = (1,9)
+	white6500 = (1,9)
+	white6500Left = (1,0)
+	white6500Right = (1,1)
+	port2 = (2,9)
+	white2800 = (2,9)
+	white2800Left = (2,0)
+	white2800Right = (2,1)
+	port3 = (3,9)
+	uv385 = (3,9)
+	port4 = (4,9)
+	uv405 = (4,9)
+	port5 = (5,9)
+	blue475 = (5,9)
+	port6 = (6,9)
+	ir850 = (6,9)
+	port7 = (7,9)
+	ir940 = (7,9)
+	port8 = (8,9)
+	raking = (8,9)
+	def __init__(self,writeCommand=False):
 		import simplepyble
-		self.port0 = (0,9)
-		self.test = (0,9) # format is port, octopus index where 9 is all octopodes
-		self.testLeft = (0,0)
-		self.testRight = (0,1)
-		self.port1 = (1,9)
-		self.white6500 = (1,9)
-		self.white6500Left = (1,0)
-		self.white6500Right = (1,1)
-		self.port2 = (2,9)
-		self.white2800 = (2,9)
-		self.white2800Left = (2,0)
-		self.white2800Right = (2,1)
-		self.port3 = (3,9)
-		self.uv385 = (3,9)
-		self.port4 = (4,9)
-		self.uv405 = (4,9)
-		self.port5 = (5,9)
-		self.blue475 = (5,9)
-		self.port6 = (6,9)
-		self.ir850 = (6,9)
-		self.port7 = (7,9)
-		self.ir940 = (7,9)
-		self.port8 = (8,9)
-		self.raking = (8,9)
+		from concurrent.futures import ThreadPoolExecutor
 		scantime = int(5)
-		self.serviceuuid = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E".lower()
+		self.writeCommand = writeCommand
+		cache = self.readCache()
 		adapters = simplepyble.Adapter.get_adapters()
+		adapter = None
 		if len(adapters) == 0:
 			print("No bluetooth adapters found on this machine")
+			exit()
 		elif len(adapters) == 1:
 			adapter = adapters[0]
 		else:
-			for adapter in adapters:
-				print(f"Adapter: {adapter.identifier()} [{adapter.address()}]")
-			print("Please select a local bluetooth adapter:") 
-			for i, adapter in enumerate(adapters):
-				print(f"{i}: {adapter.identifier()} [{adapter.address()}]")
-			choice = int(input("Enter choice: "))
-			adapter = adapters[choice]
+			for candidate in adapters:
+				if candidate.address() == cache.get('adapter'):
+					adapter = candidate
+			if adapter is None:
+				print("Please select a local bluetooth adapter:") 
+				for i, candidate in enumerate(adapters):
+					print(f"{i}: {candidate.identifier()} [{candidate.address()}]")
+				choice = int(input("Enter choice: "))
+				adapter = adapters[choice]
 		print(f"Selected local bluetooth adapter: {adapter.identifier()} [{adapter.address()}]")
-		adapter.set_callback_on_scan_start(lambda: print("Scan started."))
-		adapter.set_callback_on_scan_stop(lambda: print("Scan complete."))
-		adapter.set_callback_on_scan_found(lambda peripheral: print(f"Found {peripheral.identifier()} [{peripheral.address()}]"))
-		adapter.scan_for(scantime*1000)
-		results = adapter.scan_get_results()
-		self.octopodes = []
-		for result in results:
-			services = result.services()
-			for service in services:
-				if service.uuid() == self.serviceuuid:
-					self.octopodes.append(result) 
-		try:
-			for octopus in self.octopodes:
+		known = set(cache.get('octopodes',[]))
+		found = {}
+		allFound = threading.Event()
+		def onFound(peripheral):
+			print(f"Found {peripheral.identifier()} [{peripheral.address()}]") if verbose > 3 else None
+			if peripheral.address() in known or self.serviceuuid in [service.uuid() for service in peripheral.services()]:
+				found[peripheral.address()] = peripheral
+			if known and known.issubset(found):
+				allFound.set()
+		adapter.set_callback_on_scan_found(onFound)
+		adapter.scan_start()
+		allFound.wait(scantime) # stops early once every cached board has been seen
+		adapter.scan_stop()
+		if known and not allFound.is_set():
+			print("Only found %s of %s Octopus boards seen last time"%(len(known.intersection(found)),len(known)))
+		self.octopodes = [found[address] for address in sorted(found)] # same board order every session
+		for octopus in self.octopodes:
+			try:
 				print(f"Connecting to: {octopus.identifier()} [{octopus.address()}]")
 				octopus.connect()
-		except:
-			print("Not able to find and connect to a peripheral offering service %s"%(self.serviceuuid))
+			except Exception as e:
+				print("Not able to connect to %s offering service %s: %s"%(octopus.address(),self.serviceuuid,e))
+		if len(self.octopodes) > 0:
+			self.writeCache(adapter.address(),[octopus.address() for octopus in self.octopodes])
+		else:
+			print("Not able to find a peripheral offering service %s"%(self.serviceuuid))
+		self.executor = ThreadPoolExecutor(max_workers=max(1,len(self.octopodes)),thread_name_prefix='OctopusBluetooth')
+	def readCache(self):
+		if not path.exists(self.cachePath):
+			return {}
+		import yaml
+		with open(self.cachePath,'r') as unparsedyaml:
+			return yaml.load(unparsedyaml,Loader=yaml.SafeLoader) or {}
+	def writeCache(self,adapterAddress,addresses):
+		import yaml
+		if not path.exists(path.dirname(self.cachePath)):
+			makedirs(path.dirname(self.cachePath))
+		with open(self.cachePath,'w') as unparsedyaml:
+			yaml.dump({'adapter':adapterAddress,'octopodes':addresses},unparsedyaml)
+	def send(self,command,index=9):
+		"""
+		Writes one command to every board, or only board index when index is 0-8, all at the same time
+		"""
+		def write(octopus):
+			if self.writeCommand:
+				octopus.write_command(self.serviceuuid,self.characteristicRx,command.to_bytes(1))
+			else:
+				octopus.write_request(self.serviceuuid,self.characteristicRx,command.to_bytes(1))
+		boards = [octopus for num, octopus in enumerate(self.octopodes) if index > 8 or index == num]
+		for octopus, future in [(octopus,self.executor.submit(write,octopus)) for octopus in boards]:
+			try:
+				future.result()
+			except Exception as e:
+				print("Failure trying to write command %s to %s: %s"%(command,octopus.address(),e))
 	def on(self,light,exposure):
-		characteristicRx = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E".lower()
 		port = getattr(self,light)
-		try:
-			for num, octopus in enumerate(self.octopodes): 
-				if port[1] > 8 or port[1] == num:
-					print("Asking Octopus index %s at %s to turn on port %s for light %s for %s milliseconds"%(num,octopus.address(),port[0],light,exposure))
-					octopus.write_request(self.serviceuuid,characteristicRx,port[0].to_bytes(1)) # octopus interprets integer 0-8 as turn on that port
-		except:
-			print("Failure trying to write command %s-%s to %s"%(port[0],port[1],characteristicRx))
-		time.sleep(exposure/1000)
-		try:
-			for octopus in self.octopodes: 
-				octopus.write_request(self.serviceuuid,characteristicRx,int(10).to_bytes(1)) # octopus interprets a number greater than known ports (1 internal, 8 ports) as all off
-		except:
-			print("Failure trying to write command 10 %s"%(characteristicRx))
+		print("Asking Octopus index %s to turn on port %s for light %s for %s milliseconds"%(port[1],port[0],light,exposure))
+		self.send(port[0],port[1]) # octopus interprets integer 0-8 as turn on that port
+		waitReady(self,light)
+		time.sleep(int(exposure)/1000)
+		self.off()
+	def manualon(self,light):
+		port = getattr(self,light)
+		print("Asking Octopus index %s to turn on port %s for light %s indefinately"%(port[1],port[0],light)) if verbose > 3 else None
+		self.send(port[0],port[1])
+	def off(self):
+		self.send(10) # octopus interprets a number greater than known ports (1 internal, 8 ports) as all off
 	def close(self):
-		try:
-			for octopus in self.octopodes:
+		self.executor.shutdown()
+		for octopus in self.octopodes:
+			try:
 				print("Closing %s"%(octopus.address()))
 				octopus.disconnect()
-				print("Closed")
-		except:
-			print("Error trying to close bluetooth connection")
-
+			except Exception as e:
+				print("Error trying to close bluetooth connection to %s: %s"%(octopus.address(),e))
@@ -31,13 +31,26 @@ def initializeWebcam():
 		ret = camera.set(cv2.CAP_PROP_FRAME_HEIGHT,height)
 		ret = camera.set(cv2.CAP_PROP_FRAME_WIDTH,width)
 
+def daemonCamera():
+	"""
+	Camera held open by capturedaemon.py, or False to open one here
+	"""
+	import libdaemon
+	client = libdaemon.connect()
+	if not client:
+		return False
+	print("Using the camera held open by the capture daemon")
+	return libdaemon.LiveCamera(client)
+
 def initializeQhy(): 
 	global camera,exposure,binXY,roiX,roiY,width,height,roiW,roiH,cameraName,filterwheel
 	if not camera:
 		exposure = 16 # exposure = 1
-		import libqhy 
-		camera = libqhy.Qhyccd()
-		camera.connect(1) # 1 is stream, 0 is single frame
+		camera = daemonCamera()
+		if not camera:
+			import libqhy 
+			camera = libqhy.Qhyccd()
+			camera.connect(1) # 1 is stream, 0 is single frame
 		cameraName = bytes(camera.id).decode()
 		if cameraName.startswith('QHYminiCam'):
 			print("Applying settings for QHY miniCam8")
@@ -104,10 +117,12 @@ def initializeFlir():
 	global camera,exposure,binXY,roiX,roiY,width,height,roiW,roiH,cameraName,filterwheel
 	if not camera:
 		exposure = 16 
-		import libflir
-		camera = libflir.Flir()
-		config = {'gain':11.1,'bpp':8}
-		camera.session(config,'liveview')
+		camera = daemonCamera()
+		if not camera:
+			import libflir
+			camera = libflir.Flir()
+			config = {'gain':11.1,'bpp':8}
+			camera.session(config,'liveview')
 		cameraName = 'Flir'
 		height = 3648
 		width = 5472
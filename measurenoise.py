@@ -4,6 +4,7 @@ import sys
 import os
 from skimage import io, img_as_uint, img_as_float32
 import numpy as np
+from libstats import FrameStats
 
 """
 measurenoise.py takes as an argument one or more snr.yaml files
@@ -17,8 +18,9 @@ measurenoise.py will overwrite the snr.yaml file and comments will be lost
 verbose = 3
 
 def snrfromimg(img,x,y,w,h):
-	noise = np.std(img[y:y+h,x:x+w])
-	linearsnr = np.mean(img[y:y+h,x:x+w]) / noise
+	stats = FrameStats(img[y:y+h,x:x+w])
+	noise = stats.std
+	linearsnr = stats.mean / noise
 	dbsnr = 10 * np.log10(linearsnr)
 	linearsnr = float(linearsnr)
 	dbsnr = float(dbsnr)